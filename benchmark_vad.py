@@ -0,0 +1,56 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from whisperx.audio import SAMPLE_RATE, load_audio
+from whisperx.vad import load_vad_model, merge_chunks
+
+
+def speech_mask(chunks, num_frames, fps=100):
+    mask = np.zeros(num_frames, dtype=bool)
+    for chunk in chunks:
+        for start, end in chunk["segments"]:
+            mask[int(start * fps):int(end * fps)] = True
+    return mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the VAD backends on the same audio files")
+    parser.add_argument("audio", nargs="+", type=str, help="audio file(s) to run VAD on")
+    parser.add_argument("--methods", nargs="+", default=["pyannote", "energy"], help="VAD backends to compare, the first one is the reference")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="device to run the VAD on")
+    parser.add_argument("--chunk_size", type=int, default=30, help="chunk size for merging VAD segments")
+    parser.add_argument("--vad_onset", type=float, default=0.500)
+    parser.add_argument("--vad_offset", type=float, default=0.363)
+    args = parser.parse_args()
+
+    models = {method: load_vad_model(args.device, vad_method=method) for method in args.methods}
+    for audio_path in args.audio:
+        audio = load_audio(audio_path)
+        duration = audio.shape[0] / SAMPLE_RATE
+        num_frames = int(duration * 100) + 1
+        reference = None
+        print(f"{audio_path} ({duration:.1f}s)")
+        for method, model in models.items():
+            start_time = time.perf_counter()
+            scores = model({"waveform": torch.from_numpy(audio).unsqueeze(0), "sample_rate": SAMPLE_RATE})
+            chunks = merge_chunks(scores, args.chunk_size, onset=args.vad_onset, offset=args.vad_offset)
+            elapsed = time.perf_counter() - start_time
+
+            mask = speech_mask(chunks, num_frames)
+            line = (
+                f"  {method:>10}: {sum(len(c['segments']) for c in chunks)} segments, {len(chunks)} chunks, "
+                f"{mask.sum() / 100:.1f}s speech, {elapsed:.2f}s ({duration / elapsed:.0f}x real time)"
+            )
+            if reference is None:
+                reference = mask
+            else:
+                union = (mask | reference).sum()
+                line += f", speech IoU with {args.methods[0]}: {(mask & reference).sum() / union if union else 1.0:.3f}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
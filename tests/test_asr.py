@@ -0,0 +1,224 @@
+import threading
+import time
+
+import faster_whisper
+import numpy as np
+import pytest
+from pyannote.core import SlidingWindow, SlidingWindowFeature
+
+from whisperx import asr
+
+LANGUAGE_TOKENS = {"en": 1, "de": 2, "fr": 3}
+TASK_TOKENS = {"transcribe": 4, "translate": 5}
+
+
+class FakeResult:
+    def __init__(self, tokens):
+        self.sequences_ids = [tokens]
+        self.scores = [-0.1]
+        self.no_speech_prob = 0.0
+
+
+class FakeHFTokenizer:
+    def decode_batch(self, tokens_batch):
+        return [" ".join(str(token) for token in tokens) for tokens in tokens_batch]
+
+    def to_str(self):
+        return "fake-vocabulary"
+
+
+class FakeTokenizer:
+    def __init__(self, hf_tokenizer, multilingual, task, language):
+        self.language_code = language
+        self.task = task
+        self.eot = 100
+        self.tokenizer = FakeHFTokenizer()
+
+    def encode(self, text):
+        return []
+
+    def decode(self, tokens):
+        return str(tokens[0])
+
+
+class FakeCTranslate2Model:
+    device = "cpu"
+    device_index = [0]
+    is_multilingual = True
+
+    def encode(self, features, to_cpu=False):
+        return np.asarray(features).mean(axis=(1, 2), keepdims=True)
+
+    def detect_language(self, encoder_output):
+        return [[("<|en|>", 0.9), ("<|de|>", 0.1)] for _ in range(np.asarray(encoder_output).shape[0])]
+
+    def generate(self, encoder_output, prompts, max_length=448, **kwargs):
+        # give other threads the chance to run while a batch is "decoded"
+        time.sleep(0.001)
+        values = np.asarray(encoder_output).reshape(len(prompts), -1)[:, 0]
+        # the text starts with the prompt, so a tokenizer leaking between calls shows in it
+        return [FakeResult([*prompt, int(abs(value) * 1000) % 50 + 10]) for prompt, value in zip(prompts, values)]
+
+
+class FakeWhisperModel(asr.WhisperModel):
+    def __init__(self):
+        self.model = FakeCTranslate2Model()
+        self.feat_kwargs = {"feature_size": 80}
+        self.max_length = 448
+        self.time_precision = 0.02
+        self.hf_tokenizer = None
+
+    def get_prompt(self, tokenizer, previous_tokens, without_timestamps=False, prefix=None):
+        return [LANGUAGE_TOKENS[tokenizer.language_code], TASK_TOKENS[tokenizer.task]]
+
+
+def fake_vad(file):
+    # speech wherever the waveform is loud, one score per 10 ms
+    waveform = file["waveform"].reshape(-1).numpy()
+    num_frames = len(waveform) // 160
+    energy = np.abs(waveform[: num_frames * 160]).reshape(num_frames, 160).mean(axis=1)
+    scores = np.clip(energy, 0, 1)[:, None].astype(np.float32)
+    return SlidingWindowFeature(scores, SlidingWindow(start=0.0, duration=0.01, step=0.01))
+
+
+def make_audio(seed: int, seconds: int = 90) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    envelope = np.zeros(seconds * 100, dtype=np.float32)
+    t = 0
+    while t < len(envelope):
+        turn = int(rng.uniform(50, 1500))
+        envelope[t : t + turn] = rng.uniform(0.6, 0.9)
+        t += turn + int(rng.uniform(5, 200))
+    return (np.repeat(envelope, 160) * np.sign(rng.standard_normal(len(envelope) * 160))).astype(np.float32)
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    monkeypatch.setattr(faster_whisper.tokenizer, "Tokenizer", FakeTokenizer)
+    values = {
+        "beam_size": 5,
+        "best_of": 5,
+        "patience": 1,
+        "length_penalty": 1,
+        "repetition_penalty": 1,
+        "no_repeat_ngram_size": 0,
+        "temperatures": [0.0, 0.2, 0.4],
+        "compression_ratio_threshold": 2.4,
+        "log_prob_threshold": -1.0,
+        "no_speech_threshold": 0.6,
+        "condition_on_previous_text": False,
+        "prompt_reset_on_temperature": 0.5,
+        "suppress_blank": True,
+        "suppress_tokens": [-1],
+        "without_timestamps": True,
+        "max_initial_timestamp": 0.0,
+        "word_timestamps": False,
+    }
+    # options added by later faster-whisper versions are left unset
+    fields = faster_whisper.transcribe.TranscriptionOptions._fields
+    options = faster_whisper.transcribe.TranscriptionOptions(**{field: values.get(field) for field in fields})
+    return asr.FasterWhisperPipeline(
+        model=FakeWhisperModel(),
+        vad=fake_vad,
+        vad_params={"vad_onset": 0.5, "vad_offset": 0.363},
+        options=options,
+    )
+
+
+def test_concurrent_transcribe_shares_weights(pipeline):
+    audios = [make_audio(seed) for seed in range(4)]
+    calls = [
+        {"audio": audios[i % len(audios)], "language": ["en", "de", "fr"][i % 3], "task": ["transcribe", "translate"][i % 2]}
+        for i in range(8)
+    ]
+    options = pipeline.options
+    expected = [pipeline.transcribe(call["audio"], batch_size=3, language=call["language"], task=call["task"]) for call in calls]
+
+    results = [None] * len(calls)
+    errors = []
+
+    def run(i):
+        try:
+            for _ in range(3):
+                result = pipeline.transcribe(calls[i]["audio"], batch_size=3, language=calls[i]["language"], task=calls[i]["task"])
+                if results[i] is not None and result != results[i]:
+                    errors.append(f"thread {i} returned different results across calls")
+                results[i] = result
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert results == expected
+    for call, result in zip(calls, results):
+        prompt = f"{LANGUAGE_TOKENS[call['language']]} {TASK_TOKENS[call['task']]} "
+        assert result["language"] == call["language"]
+        assert len(result["segments"]) > 0
+        assert all(segment["text"].startswith(prompt) for segment in result["segments"])
+    # transcribe leaves the shared pipeline untouched
+    assert pipeline.tokenizer is None
+    assert pipeline.options is options
+
+
+@pytest.mark.parametrize("batch_schedule", ["time", "length"])
+def test_transcribe_with_dataloader_workers(pipeline, batch_schedule):
+    audio = make_audio(0)
+    expected = pipeline.transcribe(audio, batch_size=4, language="en", batch_schedule=batch_schedule)
+    result = pipeline.transcribe(audio, batch_size=4, language="en", batch_schedule=batch_schedule, num_workers=1)
+    assert result == expected
+    assert len(result["segments"]) > 0
+
+
+def test_streaming_vad_rejects_dataloader_workers(pipeline):
+    with pytest.raises(ValueError):
+        pipeline.transcribe(make_audio(0), batch_size=4, language="en", streaming_vad=True, num_workers=1)
+
+
+def test_adaptive_batch_size_requires_profile(pipeline):
+    with pytest.raises(ValueError):
+        pipeline.transcribe(make_audio(0), batch_size="auto", language="en")
+
+
+def test_length_budgets():
+    model = FakeWhisperModel()
+    english = FakeTokenizer(None, True, "transcribe", "en")
+    japanese = FakeTokenizer(None, True, "transcribe", "ja")
+    assert model._length_budgets(english, None) is None
+    assert model._length_budgets(english, [0.0, 1.0, 2.05]) == [16, 28, 41]
+    assert model._length_budgets(japanese, [1.0]) == [36]
+    # never more than the model can decode
+    assert model._length_budgets(english, [3600.0]) == [448]
+
+
+def test_generation_length_counts_prompt():
+    model = FakeWhisperModel()
+    assert model._generation_length([1, 4], None) == 448
+    assert model._generation_length([1, 4], [16, 41, 28]) == 43
+    assert model._generation_length([1, 4], [448]) == 448
+
+
+def test_cap_lengths():
+    budgets = [3, 5, 5]
+    tokens_batch = [[10, 11, 12, 13, 14], [10, 11], [10, 11, 12, 13, 14]]
+    capped, length_capped = asr.WhisperModel._cap_lengths(tokens_batch, budgets)
+    assert capped == [[10, 11, 12], [10, 11], [10, 11, 12, 13, 14]]
+    # the last item was stopped by max_length at exactly its budget
+    assert length_capped == 2
+
+
+def test_transcribe_empty_audio_stats(pipeline):
+    result = pipeline.transcribe(np.zeros(0, dtype=np.float32), batch_size=4, language="en", return_stats=True)
+    assert result["segments"] == []
+    assert result["stats"]["rtf"] == 0.0
+
+
+def test_chunk_inputs_cuts_audio_at_the_sample():
+    audio = make_audio(0, seconds=5)
+    segments = [{"start": 0.123456, "end": 1.987654, "segments": [(0.123456, 1.987654)]}]
+    (item,) = asr.chunk_inputs(audio, segments)
+    np.testing.assert_array_equal(item["inputs"], audio[int(0.123456 * 16000) : int(1.987654 * 16000)])
@@ -0,0 +1,12 @@
+from whisperx.batching import AdaptiveBatchSize
+
+
+def test_adaptive_batch_size_state_keeps_best_measured_size():
+    controller = AdaptiveBatchSize(latency_budget=1.0, initial=4, max_size=64)
+    controller.update(4, 0.1)
+    # the next batch probes a larger size, which has no throughput yet
+    assert controller.batch_size == 8
+    assert controller.state() == {"batch_size": 4, "throughput": 40.0, "limit": 65}
+
+    controller.update(8, 1.5)
+    assert controller.state() == {"batch_size": 4, "throughput": 40.0, "limit": 8}
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+import torch
+from pyannote.core import Annotation, Segment, SlidingWindow, SlidingWindowFeature
+
+from whisperx.vad import Binarize, merge_chunks, merge_chunks_streaming
+
+
+def reference_binarize(scores: SlidingWindowFeature, onset: float, offset: float, max_duration: float) -> Annotation:
+    # the per-frame loop of Binarize before it was vectorized
+    num_frames, num_classes = scores.data.shape
+    frames = scores.sliding_window
+    timestamps = [frames[i].middle for i in range(num_frames)]
+
+    active = Annotation()
+    for k, k_scores in enumerate(scores.data.T):
+        label = k if scores.labels is None else scores.labels[k]
+
+        start = timestamps[0]
+        is_active = k_scores[0] > onset
+        curr_scores = [k_scores[0]]
+        curr_timestamps = [start]
+        t = start
+        for t, y in zip(timestamps[1:], k_scores[1:]):
+            if is_active:
+                curr_duration = t - start
+                if curr_duration > max_duration:
+                    search_after = len(curr_scores) // 2
+                    min_score_div_idx = search_after + np.argmin(curr_scores[search_after:])
+                    min_score_t = curr_timestamps[min_score_div_idx]
+                    active[Segment(start, min_score_t), k] = label
+                    start = curr_timestamps[min_score_div_idx]
+                    curr_scores = curr_scores[min_score_div_idx + 1:]
+                    curr_timestamps = curr_timestamps[min_score_div_idx + 1:]
+                elif y < offset:
+                    active[Segment(start, t), k] = label
+                    start = t
+                    is_active = False
+                    curr_scores = []
+                    curr_timestamps = []
+                curr_scores.append(y)
+                curr_timestamps.append(t)
+            else:
+                if y > onset:
+                    start = t
+                    is_active = True
+
+        if is_active:
+            active[Segment(start, t), k] = label
+    return active
+
+
+def random_scores(rng: np.random.Generator, kind: int) -> SlidingWindowFeature:
+    num_frames = int(rng.integers(1, 2000))
+    if kind == 0:
+        # frame-level noise: many short regions
+        y = rng.random(num_frames)
+    elif kind == 1:
+        # piecewise constant: long runs of equal scores
+        y = np.repeat(rng.random(num_frames // 20 + 1), 20)[:num_frames]
+    else:
+        # random walk: long regions that the min-cut has to divide
+        y = np.clip(np.cumsum(rng.normal(0, 0.05, num_frames)) + 0.5, 0, 1)
+    sliding_window = SlidingWindow(start=float(rng.random()), duration=0.0619, step=0.016875)
+    return SlidingWindowFeature(y.astype(np.float32)[:, None], sliding_window)
+
+
+def tracks(annotation: Annotation):
+    return [(segment.start, segment.end, track, label) for segment, track, label in annotation.itertracks(yield_label=True)]
+
+
+@pytest.mark.parametrize("max_duration", [float("inf"), 30.0, 5.0, 1.0, 0.2, 0.01])
+def test_binarize_matches_reference(max_duration):
+    rng = np.random.default_rng(int(max_duration * 100) if max_duration < float("inf") else 0)
+    for trial in range(150):
+        scores = random_scores(rng, trial % 3)
+        onset = float(rng.choice([0.3, 0.5, 0.7]))
+        offset = float(rng.choice([0.2, 0.363, 0.5, 0.8]))
+        expected = reference_binarize(scores, onset, offset, max_duration)
+        actual = Binarize(onset=onset, offset=offset, max_duration=max_duration)(scores)
+        assert tracks(actual) == tracks(expected), (trial, onset, offset)
+
+
+def test_binarize_no_frames():
+    scores = SlidingWindowFeature(np.zeros((0, 1), dtype=np.float32), SlidingWindow(start=0.0, duration=0.025, step=0.01))
+    assert len(Binarize(onset=0.5, offset=0.363, max_duration=30)(scores)) == 0
+
+
+def energy_vad(hop: int):
+    # a frame's score only depends on its own samples, as if the model saw the whole file
+    def vad(file):
+        waveform = file["waveform"].reshape(-1).numpy()
+        num_frames = len(waveform) // hop
+        energy = np.abs(waveform[: num_frames * hop]).reshape(num_frames, hop).mean(axis=1)
+        scores = np.clip(energy, 0, 1)[:, None].astype(np.float32)
+        return SlidingWindowFeature(scores, SlidingWindow(start=0.0, duration=hop / 16000, step=hop / 16000))
+    return vad
+
+
+def chunk_bounds(chunks):
+    return [(chunk["start"], chunk["end"], *[t for segment in chunk["segments"] for t in segment]) for chunk in chunks]
+
+
+@pytest.mark.parametrize("hop", [160, 270])
+def test_merge_chunks_streaming_matches_merge_chunks(hop):
+    rng = np.random.default_rng(hop)
+    envelope = np.repeat(rng.random(4000) < 0.7, 40).astype(np.float32) * 0.8
+    audio = np.repeat(envelope, 16) * np.sign(rng.standard_normal(len(envelope) * 16)).astype(np.float32)
+    vad = energy_vad(hop)
+    expected = merge_chunks(vad({"waveform": torch.from_numpy(audio)[None]}), 30, onset=0.5, offset=0.363)
+    actual = list(merge_chunks_streaming(vad, audio, 30, onset=0.5, offset=0.363, block_duration=45.0, overlap_duration=10.0))
+    assert len(actual) == len(expected) > 1
+    for a, e in zip(chunk_bounds(actual), chunk_bounds(expected)):
+        assert a == pytest.approx(e)
@@ -3,7 +3,7 @@ Forced Alignment with Whisper
 C. Max Bain
 """
 from dataclasses import dataclass
-from typing import Iterable, Union, List
+from typing import Iterable, Optional, Union, List
 
 import numpy as np
 import pandas as pd
@@ -17,6 +17,11 @@ from .types import AlignedTranscriptionResult, SingleSegment, SingleAlignedSegme
 import nltk
 from nltk.tokenize.punkt import PunktSentenceTokenizer, PunktParameters
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 PUNKT_ABBREVIATIONS = ['dr', 'vs', 'mr', 'mrs', 'prof']
 
 LANGUAGES_WITHOUT_SPACES = ["ja", "zh"]
@@ -236,18 +241,17 @@ def align(
             if char == '[pad]' or char == '<pad>':
                 blank_id = code
 
-        trellis = get_trellis(emission, tokens, blank_id)
-        path = backtrack(trellis, emission, tokens, blank_id)
+        path = forced_align(emission, tokens, blank_id)
 
         if path is None:
             print(f'Failed to align segment ("{segment["text"]}"): backtrack failed, resorting to original...')
             aligned_segments.append(aligned_seg)
             continue
 
-        char_segments = merge_repeats(path, text_clean)
+        char_segments = merge_path_repeats(path, text_clean)
 
         duration = t2 -t1
-        ratio = duration * waveform_segment.size(0) / (trellis.size(0) - 1)
+        ratio = duration * waveform_segment.size(0) / emission.size(0)
 
         # assign timestamps to aligned characters
         char_segments_arr = []
@@ -417,6 +421,134 @@ def backtrack(trellis, emission, tokens, blank_id=0):
         return None
     return path[::-1]
 
+@dataclass
+class AlignmentPath:
+    """The frames of a path through the trellis, as arrays in time order, see `forced_align`."""
+    token_index: np.ndarray
+    time_index: np.ndarray
+    score: np.ndarray
+
+    def __len__(self):
+        return len(self.token_index)
+
+def _trellis_first_column(emission, num_tokens):
+    # column 0 of `get_trellis`, including its inf rows; the cumulative sum is left to torch,
+    # which accumulates in double precision
+    column = np.empty(emission.size(0) + 1, dtype=np.float32)
+    column[0] = 0
+    column[1:] = torch.cumsum(emission[:, 0], 0).float().numpy()
+    column[-num_tokens:] = np.inf
+    return column
+
+def _align_numpy(emission, tokens, blank_id, first_column):
+    # the recursion of `get_trellis` one frame at a time over all tokens, recording which cells
+    # were reached by changing token so that backtracking does not have to recompute them
+    num_frame, num_tokens = emission.shape[0], len(tokens)
+    trellis = np.empty((num_frame + 1, num_tokens + 1), dtype=np.float32)
+    trellis[:, 0] = first_column
+    trellis[0, -num_tokens:] = -np.inf
+    changed = np.zeros((num_frame + 1, num_tokens + 1), dtype=bool)
+    token_emission = emission[:, tokens]
+    blank_emission = emission[:, blank_id]
+    for t in range(num_frame):
+        stayed = trellis[t, 1:] + blank_emission[t]
+        moved = trellis[t, :-1] + token_emission[t]
+        np.maximum(stayed, moved, out=trellis[t + 1, 1:])
+        np.greater(moved, stayed, out=changed[t + 1, 1:])
+
+    j = num_tokens
+    t_start = int(np.argmax(trellis[:, j]))
+    token_index = np.empty(t_start, dtype=np.int64)
+    token_changed = np.empty(t_start, dtype=bool)
+    length = 0
+    for t in range(t_start, 0, -1):
+        token_index[length] = j - 1
+        token_changed[length] = changed[t, j]
+        length += 1
+        if changed[t, j]:
+            j -= 1
+            if j == 0:
+                break
+    else:
+        return None
+    return token_index[:length], token_changed[:length], t_start
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _align_numba(emission, tokens, blank_id, first_column):
+        # `_align_numpy` in a single compiled pass, with the same float32 arithmetic
+        num_frame, num_tokens = emission.shape[0], len(tokens)
+        trellis = np.empty((num_frame + 1, num_tokens + 1), dtype=np.float32)
+        changed = np.zeros((num_frame + 1, num_tokens + 1), dtype=np.bool_)
+        trellis[:, 0] = first_column
+        trellis[0, 1:] = -np.inf
+        for t in range(num_frame):
+            for j in range(1, num_tokens + 1):
+                stayed = trellis[t, j] + emission[t, blank_id]
+                moved = trellis[t, j - 1] + emission[t, tokens[j - 1]]
+                # like torch.maximum, NaN wins
+                trellis[t + 1, j] = moved if moved > stayed or moved != moved else stayed
+                changed[t + 1, j] = moved > stayed
+
+        j = num_tokens
+        # like torch.argmax, the first maximum, or the first NaN
+        t_start = 0
+        for t in range(num_frame + 1):
+            value = trellis[t, j]
+            if value != value:
+                t_start = t
+                break
+            if value > trellis[t_start, j]:
+                t_start = t
+        token_index = np.empty(t_start, dtype=np.int64)
+        token_changed = np.empty(t_start, dtype=np.bool_)
+        length = 0
+        failed = True
+        for t in range(t_start, 0, -1):
+            token_index[length] = j - 1
+            token_changed[length] = changed[t, j]
+            length += 1
+            if changed[t, j]:
+                j -= 1
+                if j == 0:
+                    failed = False
+                    break
+        return token_index[:length], token_changed[:length], t_start, failed
+
+def forced_align(emission, tokens, blank_id=0) -> Optional[AlignmentPath]:
+    """
+    Equivalent to `backtrack(get_trellis(emission, tokens, blank_id), emission, tokens, blank_id)`,
+    giving the same path and scores, but computing the trellis and its backtracking in a single
+    compiled pass when numba is installed, or frame by frame with NumPy otherwise, and returning
+    the path as arrays rather than a list of `Point`. Returns None if backtracking fails.
+    """
+    num_tokens = len(tokens)
+    if num_tokens == 0:
+        # the trellis has no token to end on
+        return None
+    first_column = _trellis_first_column(emission, num_tokens)
+    # exact for lower precision emissions, whose sums get_trellis also computes in float32
+    emission_array = emission.float().numpy()
+    token_array = np.asarray(tokens, dtype=np.int64)
+    if numba is not None:
+        token_index, token_changed, t_start, failed = _align_numba(emission_array, token_array, blank_id, first_column)
+        if failed:
+            return None
+    else:
+        result = _align_numpy(emission_array, token_array, blank_id, first_column)
+        if result is None:
+            return None
+        token_index, token_changed, t_start = result
+
+    token_index = token_index[::-1].copy()
+    token_changed = token_changed[::-1]
+    time_index = np.arange(t_start - len(token_index), t_start, dtype=np.int64)
+    # the emission of the next token when changing, and of index 0 (not the blank) when staying,
+    # exponentiated by torch as in `backtrack`
+    score_token = np.where(token_changed, token_array[token_index], 0)
+    score = emission[torch.from_numpy(time_index), torch.from_numpy(score_token)].exp().double().numpy()
+    return AlignmentPath(token_index, time_index, score)
+
 # Merge the labels
 @dataclass
 class Segment:
@@ -450,6 +582,19 @@ def merge_repeats(path, transcript):
         i1 = i2
     return segments
 
+def merge_path_repeats(path: AlignmentPath, transcript):
+    """`merge_repeats` for the `AlignmentPath` of `forced_align`."""
+    bounds = np.flatnonzero(np.diff(path.token_index)) + 1
+    starts = np.concatenate(([0], bounds)).tolist()
+    ends = np.concatenate((bounds, [len(path)])).tolist()
+    token_index = path.token_index.tolist()
+    time_index = path.time_index.tolist()
+    score = path.score.tolist()
+    return [
+        Segment(transcript[token_index[i1]], time_index[i1], time_index[i2 - 1] + 1, sum(score[i1:i2]) / (i2 - i1))
+        for i1, i2 in zip(starts, ends)
+    ]
+
 def merge_words(segments, separator="|"):
     words = []
     i1, i2 = 0, 0
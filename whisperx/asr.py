@@ -1,6 +1,12 @@
+import collections
+import hashlib
+import itertools
+import json
 import os
+import threading
+import time
 import warnings
-from typing import List, Union, Optional, NamedTuple
+from typing import Iterable, Iterator, List, Union, Optional, NamedTuple
 
 import ctranslate2
 import faster_whisper
@@ -9,9 +15,20 @@ import torch
 from transformers import Pipeline
 from transformers.pipelines.pt_utils import PipelineIterator
 
-from .audio import N_SAMPLES, SAMPLE_RATE, load_audio, log_mel_spectrogram
-from .vad import load_vad_model, merge_chunks
+from .audio import (HOP_LENGTH, N_FRAMES, N_SAMPLES, SAMPLE_RATE, load_audio, log_mel_chunk, log_mel_frames,
+                    log_mel_spectrogram, log_mel_spectrogram_batch)
+from .batching import AdaptiveBatchSize, load_batch_profiles, save_batch_profile
+from .cache import DEFAULT_CACHE_DIR, DiskCache
+from .vad import chunk_duration, length_bucketed, load_vad_model, merge_chunks, merge_chunks_streaming, packing_stats
 from .types import TranscriptionResult, SingleSegment
+from .utils import compression_ratio
+
+# upper bound on the tokens per second of speech a transcript needs, per language; scripts without
+# spaces between words, or with many characters per syllable, take more tokens per second
+MAX_TOKENS_PER_SECOND = {"zh": 20.0, "yue": 20.0, "ja": 20.0, "th": 20.0, "ko": 15.0}
+DEFAULT_MAX_TOKENS_PER_SECOND = 12.0
+# tokens allowed on top of the per-second budget, e.g. for a word cut off at the chunk boundary
+MAX_TOKENS_SLACK = 16
 
 def find_numeral_symbol_tokens(tokenizer):
     numeral_symbol_tokens = []
@@ -22,14 +39,163 @@ def find_numeral_symbol_tokens(tokenizer):
             numeral_symbol_tokens.append(i)
     return numeral_symbol_tokens
 
+def load_numeral_symbol_tokens(tokenizer, cache_dir: str = os.path.join(DEFAULT_CACHE_DIR, "tokens")) -> List[int]:
+    """
+    `find_numeral_symbol_tokens`, persisted on disk per vocabulary so the vocabulary is only
+    scanned once per model rather than once per file.
+    """
+    vocabulary = hashlib.sha256(tokenizer.tokenizer.to_str().encode("utf-8")).hexdigest()
+    key = f"numeral-symbol-{vocabulary}-{tokenizer.eot}.json"
+    try:
+        cache = DiskCache(cache_dir)
+        path = cache.get(key)
+    except OSError:
+        # e.g. a read-only home directory: scan the vocabulary without caching the result
+        return find_numeral_symbol_tokens(tokenizer)
+    if path is not None:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    numeral_symbol_tokens = find_numeral_symbol_tokens(tokenizer)
+
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(numeral_symbol_tokens, f)
+
+    try:
+        cache.put(key, write)
+    except OSError:
+        pass
+    return numeral_symbol_tokens
+
+def select_batch(storage: ctranslate2.StorageView, indices: List[int]):
+    """
+    Select the items `indices` of a batched StorageView without leaving its device. Returns the
+    selection and the array holding its memory, which must be kept alive while it is used.
+    """
+    if storage.device == "cuda":
+        array = torch.as_tensor(storage, device="cuda")[indices].contiguous()
+    else:
+        array = np.ascontiguousarray(np.asarray(storage)[indices])
+    return ctranslate2.StorageView.from_array(array), array
+
+def hop_sample(t: float) -> int:
+    """The sample at `t` seconds, rounded to the nearest spectrogram frame."""
+    return round(t * SAMPLE_RATE / HOP_LENGTH) * HOP_LENGTH
+
+def chunk_inputs(audio: np.ndarray, segments, log_frames: Optional[torch.Tensor] = None):
+    """
+    Pipeline items for the merged VAD chunks `segments` of `audio`: the chunk audio, or its
+    log-Mel features sliced from `log_frames`, the output of `log_mel_frames` for the whole audio.
+    Features are sliced at the frame boundary nearest to each chunk edge; audio is cut at the sample.
+    """
+    to_sample = hop_sample if log_frames is not None else lambda t: int(t * SAMPLE_RATE)
+    for seg in segments:
+        duration = chunk_duration(seg)
+        if 'pieces' in seg:
+            # silence-compacted chunk: concatenate its spans of audio
+            spans = [(to_sample(start), to_sample(end)) for start, end in seg['pieces']]
+            if log_frames is not None:
+                frames = torch.cat([
+                    log_frames[:, f1 // HOP_LENGTH : f2 // HOP_LENGTH]
+                    for f1, f2 in spans
+                ], dim=1)
+                yield {'features': log_mel_chunk(frames, 0, frames.shape[1] * HOP_LENGTH), 'duration': duration}
+            else:
+                yield {'inputs': np.concatenate([audio[f1:f2] for f1, f2 in spans]), 'duration': duration}
+            continue
+        f1 = to_sample(seg['start'])
+        f2 = to_sample(seg['end'])
+        # print(f2-f1)
+        if log_frames is not None:
+            yield {'features': log_mel_chunk(log_frames, f1, f2), 'duration': duration}
+        else:
+            yield {'inputs': audio[f1:f2], 'duration': duration}
+
+def model_n_mels(model) -> int:
+    n_mels = model.feat_kwargs.get("feature_size")
+    return n_mels if n_mels is not None else 80
+
+def stack_inputs(items, n_mels: int, arena: Optional["FeatureArena"] = None):
+    """
+    Collate preprocessed pipeline items into a batch of log-Mel features and their durations,
+    written into the buffers of `arena` if given.
+    """
+    if 'audio' in items[0]:
+        # waveforms are zero padded to N_SAMPLES as they are copied into the batch
+        audio = arena.audio_buffer(len(items)) if arena is not None else torch.zeros((len(items), N_SAMPLES))
+        for row, x in zip(audio, items):
+            length = min(x['audio'].shape[0], N_SAMPLES)
+            row[:length] = x['audio'][:length]
+            if arena is not None:
+                row[length:] = 0
+        features = log_mel_spectrogram_batch(audio, n_mels=n_mels)
+        if arena is not None:
+            features = arena.features_buffer(len(items)).copy_(features)
+    elif arena is not None:
+        features = arena.features_buffer(len(items))
+        for row, x in zip(features, items):
+            row.copy_(x['inputs'])
+    else:
+        features = torch.stack([x['inputs'] for x in items])
+    batch = {'inputs': features}
+    if all(x.get('duration') is not None for x in items):
+        batch['durations'] = [x['duration'] for x in items]
+    return batch
+
+class FeatureArena:
+    """
+    Preallocated buffers that `stack_inputs` collates batches into, reused from one batch to the
+    next instead of allocating new tensors for every chunk and batch. The features buffer is
+    passed to ctranslate2 without a copy, and is page-locked when `pin_memory` is set so that
+    it is copied to the GPU faster.
+
+    A batch is only valid until the next one is collated, so an arena cannot be shared between
+    DataLoader workers or concurrent calls.
+    """
+
+    def __init__(self, n_mels: int, batch_size: int, pin_memory: bool = False):
+        self.n_mels = n_mels
+        self.pin_memory = pin_memory
+        self._audio = None
+        # buffers allocated, and batches collated into them
+        self.allocations = 0
+        self.batches = 0
+        self._allocate_features(batch_size)
+
+    def _allocate_features(self, batch_size: int):
+        self._features = torch.empty((batch_size, self.n_mels, N_FRAMES), dtype=torch.float32, pin_memory=self.pin_memory)
+        self.allocations += 1
+
+    def features_buffer(self, batch_size: int) -> torch.Tensor:
+        """A (batch_size, n_mels, N_FRAMES) view of the features buffer, grown if needed."""
+        if self._features.shape[0] < batch_size:
+            self._allocate_features(batch_size)
+        self.batches += 1
+        return self._features[:batch_size]
+
+    def audio_buffer(self, batch_size: int) -> torch.Tensor:
+        """A (batch_size, N_SAMPLES) view of the waveform buffer, grown if needed."""
+        # the waveforms are only read on the CPU by the STFT, so they are not page-locked
+        if self._audio is None or self._audio.shape[0] < batch_size:
+            self._audio = torch.empty((batch_size, N_SAMPLES), dtype=torch.float32)
+            self.allocations += 1
+        return self._audio[:batch_size]
+
 class WhisperModel(faster_whisper.WhisperModel):
     '''
     FasterWhisperModel provides batched inference for faster-whisper.
     Currently only works in non-timestamp mode and fixed prompt for all samples in batch.
     '''
 
-    def generate_segment_batched(self, features: np.ndarray, tokenizer: faster_whisper.tokenizer.Tokenizer, options: faster_whisper.transcribe.TranscriptionOptions, encoder_output = None):
+    def generate_segment_batched(self, features: np.ndarray, tokenizer: faster_whisper.tokenizer.Tokenizer, options: faster_whisper.transcribe.TranscriptionOptions, encoder_output = None, batch_stats: Optional[list] = None, item_quality: Optional[list] = None, durations: Optional[List[float]] = None):
         batch_size = features.shape[0]
+        # decoding stops at the budget of the longest chunk instead of `self.max_length`, so a
+        # hallucination loop on a short chunk no longer holds up the whole batch
+        budgets = self._length_budgets(tokenizer, durations)
         all_tokens = []
         prompt_reset_since = 0
         if options.initial_prompt is not None:
@@ -43,8 +209,11 @@ class WhisperModel(faster_whisper.WhisperModel):
             without_timestamps=options.without_timestamps,
             prefix=options.prefix,
         )
+        max_length = self._generation_length(prompt, budgets)
 
-        encoder_output = self.encode(features)
+        encoded = encoder_output is None
+        if encoded:
+            encoder_output = self.encode(features)
 
         max_initial_timestamp_index = int(
             round(options.max_initial_timestamp / self.time_precision)
@@ -56,12 +225,17 @@ class WhisperModel(faster_whisper.WhisperModel):
                 beam_size=options.beam_size,
                 patience=options.patience,
                 length_penalty=options.length_penalty,
-                max_length=self.max_length,
+                max_length=max_length,
                 suppress_blank=options.suppress_blank,
                 suppress_tokens=options.suppress_tokens,
+                return_scores=True,
+                return_no_speech_prob=True,
             )
 
         tokens_batch = [x.sequences_ids[0] for x in result]
+        length_capped = 0
+        if budgets is not None:
+            tokens_batch, length_capped = self._cap_lengths(tokens_batch, budgets)
 
         def decode_batch(tokens: List[List[int]]) -> str:
             res = []
@@ -71,9 +245,123 @@ class WhisperModel(faster_whisper.WhisperModel):
             return tokenizer.tokenizer.decode_batch(res)
 
         text = decode_batch(tokens_batch)
+        quality = [self._decode_quality(options, item_result, item_text) for item_result, item_text in zip(result, text)]
+        fallbacks = 0
+        if len(options.temperatures) > 1:
+            fallbacks = self._decode_with_fallback(encoder_output, prompt, options, tokens_batch, text, quality, decode_batch, budgets)
+        if item_quality is not None:
+            # (average log probability, compression ratio) of the decoding kept for every item
+            item_quality.extend((avg_logprob, ratio) for avg_logprob, ratio, _ in quality)
+
+        if batch_stats is not None:
+            # the batch is decoded until its longest sequence ends
+            decode_steps = max(len(x.sequences_ids[0]) for x in result)
+            batch_stats.append({
+                "size": batch_size,
+                "encoded": encoded,
+                "decode_steps": decode_steps,
+                "decode_padding": 1 - sum(len(x.sequences_ids[0]) for x in result) / (batch_size * decode_steps) if decode_steps else 0.0,
+                "fallbacks": fallbacks,
+                "length_capped": length_capped,
+            })
 
         return text
 
+    def _length_budgets(self, tokenizer, durations: Optional[List[float]]) -> Optional[List[int]]:
+        # the most tokens every item may be decoded to, from its duration of speech
+        if durations is None:
+            return None
+        rate = MAX_TOKENS_PER_SECOND.get(tokenizer.language_code, DEFAULT_MAX_TOKENS_PER_SECOND)
+        return [min(self.max_length, int(np.ceil(duration * rate)) + MAX_TOKENS_SLACK) for duration in durations]
+
+    def _generation_length(self, prompt: List[int], budgets: Optional[List[int]]) -> int:
+        # the max_length of ctranslate2 counts the prompt as well as the generated tokens
+        if budgets is None:
+            return self.max_length
+        return min(self.max_length, len(prompt) + max(budgets))
+
+    @staticmethod
+    def _cap_lengths(tokens_batch: List[List[int]], budgets: List[int]):
+        # cut every item to its own budget, as the batch is decoded up to the largest one; the
+        # sequences exclude the end of text token, so one that used up its whole budget was cut
+        capped = [tokens[:budget] for tokens, budget in zip(tokens_batch, budgets)]
+        return capped, sum(len(tokens) >= budget for tokens, budget in zip(tokens_batch, budgets))
+
+    @staticmethod
+    def _decode_quality(options: faster_whisper.transcribe.TranscriptionOptions, result, text: str):
+        # average log probability, compression ratio and whether a decoding fails the thresholds,
+        # as in faster_whisper.WhisperModel.generate_with_fallback
+        tokens = result.sequences_ids[0]
+        avg_logprob = result.scores[0] * len(tokens) ** options.length_penalty / (len(tokens) + 1)
+        ratio = compression_ratio(text.strip())
+        needs_fallback = options.compression_ratio_threshold is not None and ratio > options.compression_ratio_threshold
+        if options.log_prob_threshold is not None and avg_logprob < options.log_prob_threshold:
+            # a low log probability on a window classified as silence is not a failure
+            needs_fallback = not (
+                options.no_speech_threshold is not None and result.no_speech_prob > options.no_speech_threshold
+            )
+        return avg_logprob, ratio, needs_fallback
+
+    def _decode_with_fallback(self, encoder_output, prompt, options, tokens_batch, text, quality, decode_batch, budgets=None) -> int:
+        """
+        Re-decode the items of a batch that fail the compression ratio or log probability thresholds
+        at the next temperatures of `options`, as a smaller batch reusing their encoder output, and
+        update `tokens_batch`, `text` and their `quality` in place. Items are capped to their
+        `budgets` of tokens if given. Returns the number of items re-decoded.
+        """
+        attempts = {}
+        for i, (avg_logprob, ratio, needs_fallback) in enumerate(quality):
+            if needs_fallback:
+                attempts[i] = [(avg_logprob, ratio, tokens_batch[i], text[i])]
+
+        failing = list(attempts)
+        fallbacks = 0
+        for temperature in options.temperatures[1:]:
+            if not failing:
+                break
+            fallbacks += len(failing)
+            if temperature > 0:
+                kwargs = {"beam_size": 1, "num_hypotheses": options.best_of, "sampling_topk": 0, "sampling_temperature": temperature}
+            else:
+                kwargs = {"beam_size": options.beam_size, "patience": options.patience}
+            # `source` owns the memory of the selected encoder outputs while they are decoded
+            failing_output, source = select_batch(encoder_output, failing)
+            failing_budgets = [budgets[i] for i in failing] if budgets is not None else None
+            retry = self.model.generate(
+                failing_output,
+                [prompt] * len(failing),
+                length_penalty=options.length_penalty,
+                max_length=self._generation_length(prompt, failing_budgets),
+                suppress_blank=options.suppress_blank,
+                suppress_tokens=options.suppress_tokens,
+                return_scores=True,
+                return_no_speech_prob=True,
+                **kwargs,
+            )
+            del source
+            retry_tokens = [x.sequences_ids[0] for x in retry]
+            if failing_budgets is not None:
+                retry_tokens, _ = self._cap_lengths(retry_tokens, failing_budgets)
+            still_failing = []
+            for i, item_result, item_tokens, item_text in zip(failing, retry, retry_tokens, decode_batch(retry_tokens)):
+                avg_logprob, ratio, needs_fallback = self._decode_quality(options, item_result, item_text)
+                if needs_fallback:
+                    attempts[i].append((avg_logprob, ratio, item_tokens, item_text))
+                    still_failing.append(i)
+                else:
+                    tokens_batch[i], text[i] = item_tokens, item_text
+                    quality[i] = (avg_logprob, ratio, needs_fallback)
+            failing = still_failing
+
+        for i in failing:
+            # every temperature failed: keep the most likely decoding, preferably one that is not too repetitive
+            candidates = attempts[i]
+            if options.compression_ratio_threshold is not None:
+                candidates = [a for a in candidates if a[1] <= options.compression_ratio_threshold] or candidates
+            avg_logprob, ratio, tokens_batch[i], text[i] = max(candidates, key=lambda a: a[0])
+            quality[i] = (avg_logprob, ratio, True)
+        return fallbacks
+
     def encode(self, features: np.ndarray) -> ctranslate2.StorageView:
         # When the model is running on multiple GPUs, the encoder output should be moved
         # to the CPU since we don't know which GPU will handle the next job.
@@ -104,14 +392,25 @@ class FasterWhisperPipeline(Pipeline):
             framework = "pt",
             language : Optional[str] = None,
             suppress_numerals: bool = False,
+            batch_profile: Optional[str] = None,
+            cascade_model: Optional[WhisperModel] = None,
             **kwargs
     ):
         self.model = model
+        # a larger model re-decoding the chunks `model` is not confident about, see `transcribe`
+        self.cascade_model = cascade_model
+        # identifies the model, device and compute type the adaptive batch size is remembered for
+        self.batch_profile = batch_profile
         self.tokenizer = tokenizer
         self.options = options
         self.preset_language = language
         self.suppress_numerals = suppress_numerals
         self._batch_size = kwargs.pop("batch_size", None)
+        # per model: tokenizers per (language, task), numeral and symbol tokens, and suppress lists with them added
+        self._tokenizers = {}
+        self._numeral_symbol_token_lists = {}
+        self._suppress_token_lists = {}
+        self._cache_lock = threading.Lock()
         self._num_workers = 1
         self._preprocess_params, self._forward_params, self._postprocess_params = self._sanitize_parameters(**kwargs)
         self.call_count = 0
@@ -136,124 +435,530 @@ class FasterWhisperPipeline(Pipeline):
         preprocess_kwargs = {}
         if "tokenizer" in kwargs:
             preprocess_kwargs["maybe_arg"] = kwargs["maybe_arg"]
-        return preprocess_kwargs, {}, {}
+        forward_kwargs = {}
+        for name in ("batch_stats", "encoder_outputs", "tokenizer", "options"):
+            if name in kwargs:
+                forward_kwargs[name] = kwargs[name]
+        return preprocess_kwargs, forward_kwargs, {}
 
     def preprocess(self, audio):
-        audio = audio['inputs']
-        model_n_mels = self.model.feat_kwargs.get("feature_size")
-        features = log_mel_spectrogram(
-            audio,
-            n_mels=model_n_mels if model_n_mels is not None else 80,
-            padding=N_SAMPLES - audio.shape[0],
-        )
-        return {'inputs': features}
+        duration = audio.get('duration')
+        if 'features' in audio:
+            # already sliced from the whole-file spectrogram
+            return {'inputs': audio['features'], 'duration': duration}
+        # padded, and turned into features for the whole batch at once, when collating, see get_iterator
+        return {'audio': torch.from_numpy(audio['inputs']), 'duration': duration}
+
+    @property
+    def _pin_memory(self):
+        # page-locked features are copied to the GPU faster
+        return self.model.model.device == "cuda" and torch.cuda.is_available()
 
-    def _forward(self, model_inputs):
-        outputs = self.model.generate_segment_batched(model_inputs['inputs'], self.tokenizer, self.options)
-        return {'text': outputs}
+    @property
+    def _n_mels(self):
+        return model_n_mels(self.model)
+
+    def _forward(self, model_inputs, batch_stats=None, encoder_outputs=None, tokenizer=None, options=None):
+        # encoder outputs already computed for the first batches, in order
+        encoder_output = encoder_outputs.popleft() if encoder_outputs else None
+        quality = []
+        outputs = self.model.generate_segment_batched(
+            model_inputs['inputs'],
+            tokenizer or self.tokenizer,
+            options or self.options,
+            encoder_output=encoder_output,
+            batch_stats=batch_stats,
+            item_quality=quality,
+            durations=model_inputs.get('durations'),
+        )
+        return {'text': outputs, 'quality': quality}
 
     def postprocess(self, model_outputs):
         return model_outputs
 
     def get_iterator(
-        self, inputs, num_workers: int, batch_size: int, preprocess_params, forward_params, postprocess_params
+        self, inputs, num_workers: int, batch_size: int, preprocess_params, forward_params, postprocess_params, arena=None
     ):
         dataset = PipelineIterator(inputs, self.preprocess, preprocess_params)
         if "TOKENIZERS_PARALLELISM" not in os.environ:
             os.environ["TOKENIZERS_PARALLELISM"] = "false"
         # TODO hack by collating feature_extractor and image_processor
 
+        n_mels = self._n_mels
+
         def stack(items):
-            return {'inputs': torch.stack([x['inputs'] for x in items])}
+            return stack_inputs(items, n_mels, arena)
         dataloader = torch.utils.data.DataLoader(dataset, num_workers=num_workers, batch_size=batch_size, collate_fn=stack)
         model_iterator = PipelineIterator(dataloader, self.forward, forward_params, loader_batch_size=batch_size)
         final_iterator = PipelineIterator(model_iterator, self.postprocess, postprocess_params)
         return final_iterator
 
     def transcribe(
-        self, audio: Union[str, np.ndarray], batch_size=None, num_workers=0, language=None, task=None, chunk_size=30, print_progress = False, combined_progress=False
+        self, audio: Union[str, np.ndarray], batch_size=None, num_workers=0, language=None, task=None, chunk_size=30, print_progress = False, combined_progress=False, precompute_mel=False, streaming_vad=False, chunk_packing="greedy", max_silence=None, batch_schedule="time", latency_budget=10.0, lid_windows=1, cascade_logprob_threshold=-0.5, cascade_compression_ratio_threshold=2.0, return_stats=False
     ) -> TranscriptionResult:
+        '''
+        Transcribe the speech regions of `audio` in batches of VAD chunks.
+
+        If `precompute_mel` is set, the log-Mel frames of the whole file are computed once and each
+        chunk's input is sliced from them, instead of running a separate STFT per chunk. Chunk edges
+        are rounded to the nearest frame, and the inputs differ from those of the same cut in the
+        first two frames of each chunk (or of each piece of a chunk with silences removed), its
+        last frame and the two after it, which see the neighbouring audio instead of padding.
+
+        If `streaming_vad` is set, VAD runs block by block with bounded memory and ASR starts on
+        the first chunks before VAD reaches the end of the file. It requires `num_workers=0`.
+
+        `chunk_packing` selects how VAD segments are merged into chunks, see `vad.ChunkMerger`.
+
+        If `max_silence` is set, silences longer than `max_silence` seconds between the speech
+        turns of a chunk are cut out of its audio, so more speech fits in each window. Segments are
+        decoded without timestamps, so their start and end are those of their chunk, which stay in
+        original-file time; nothing needs to be mapped back.
+
+        `batch_schedule` is "time" to batch chunks in chronological order, or "length" to batch
+        chunks of similar duration together so batches stop decoding sooner, see
+        `vad.length_bucketed`. Segments are returned in chronological order either way.
+
+        If `batch_size` is "auto", the batch size is adapted to the measured latency of each batch
+        so that batches take at most `latency_budget` seconds, see `batching.AdaptiveBatchSize`.
+        The chosen size is remembered per model, device, compute type and beam size for later runs,
+        so the pipeline needs a `batch_profile` naming them, as set by `load_model`.
+
+        If the language is not given, it is detected on the first batch of chunks, whose encoding
+        is reused for transcription. With `lid_windows` > 1, it is instead detected on that many
+        chunks spread over the file (the first ones when streaming), encoded in a single batch,
+        and their language probabilities are averaged, weighted by their duration of speech.
+
+        If the pipeline has a `cascade_model`, chunks whose decoding has an average log probability
+        below `cascade_logprob_threshold` or a compression ratio above
+        `cascade_compression_ratio_threshold` are decoded again, in batches, with that model.
+
+        If `return_stats` is set, the result also holds a "stats" dict describing the run.
+        '''
+        start_time = time.perf_counter()
         if isinstance(audio, str):
             audio = load_audio(audio)
 
-        def data(audio, segments):
-            for seg in segments:
-                f1 = int(seg['start'] * SAMPLE_RATE)
-                f2 = int(seg['end'] * SAMPLE_RATE)
-                # print(f2-f1)
-                yield {'inputs': audio[f1:f2]}
-
-        vad_segments = self.vad_model({"waveform": torch.from_numpy(audio).unsqueeze(0), "sample_rate": SAMPLE_RATE})
-        vad_segments = merge_chunks(
-            vad_segments,
-            chunk_size,
-            onset=self._vad_params["vad_onset"],
-            offset=self._vad_params["vad_offset"],
-        )
+        log_frames = log_mel_frames(audio, n_mels=self._n_mels) if precompute_mel else None
+
+        if streaming_vad:
+            if num_workers > 0:
+                raise ValueError("streaming_vad requires num_workers=0, chunks are found as the main process consumes them")
+            vad_segments = []
+
+            def vad_chunks():
+                # chunks are recorded as the pipeline consumes them
+                for chunk in merge_chunks_streaming(
+                    self.vad_model,
+                    audio,
+                    chunk_size,
+                    onset=self._vad_params["vad_onset"],
+                    offset=self._vad_params["vad_offset"],
+                    packing=chunk_packing,
+                    max_silence=max_silence,
+                ):
+                    vad_segments.append(chunk)
+                    yield chunk
+            chunks = vad_chunks()
+        else:
+            vad_segments = self.vad_model({"waveform": torch.from_numpy(audio).unsqueeze(0), "sample_rate": SAMPLE_RATE})
+            vad_segments = merge_chunks(
+                vad_segments,
+                chunk_size,
+                onset=self._vad_params["vad_onset"],
+                offset=self._vad_params["vad_offset"],
+                packing=chunk_packing,
+                max_silence=max_silence,
+            )
+            chunks = vad_segments
+
+        batch_size = batch_size or self._batch_size
+        adaptive = batch_size == "auto"
+        if adaptive:
+            if self.batch_profile is None:
+                raise ValueError("batch_size='auto' requires a pipeline with a batch_profile, see `load_model`")
+            profile = f"{self.batch_profile}-beam{self.options.beam_size}"
+            previous = load_batch_profiles().get(profile, {})
+            max_size = 64
+            if previous.get("limit") and previous.get("latency_budget") == latency_budget:
+                # a size that exceeded this budget before is not probed again
+                max_size = max(1, min(max_size, previous["limit"] - 1))
+            controller = AdaptiveBatchSize(latency_budget=latency_budget, initial=previous.get("batch_size", 8), max_size=max_size)
+        if batch_schedule not in ("time", "length"):
+            raise ValueError(f"Unsupported batch schedule: {batch_schedule}")
+
+        # encoder passes run for language detection, including the one reused by the first batch
+        lid_passes = 0
+        if self.tokenizer is None and language is None and lid_windows > 1:
+            if streaming_vad:
+                lid_chunks = list(itertools.islice(chunks, lid_windows))
+                chunks = itertools.chain(lid_chunks, chunks)
+            else:
+                picks = np.unique(np.linspace(0, len(vad_segments) - 1, lid_windows).round().astype(int)) if vad_segments else []
+                lid_chunks = [vad_segments[i] for i in picks]
+            if lid_chunks:
+                features = stack_inputs([self.preprocess(x) for x in chunk_inputs(audio, lid_chunks, log_frames)], self._n_mels)['inputs']
+                language = self.detect_language(
+                    audio,
+                    encoder_output=self.model.encode(features),
+                    weights=[sum(end - start for start, end in chunk['segments']) for chunk in lid_chunks],
+                )
+                lid_passes += 1
+
+        # (index, chunk) in the order chunks are sent to the model
+        if streaming_vad:
+            # filled as the pipeline consumes the chunks, which is why streaming needs num_workers=0
+            scheduled = []
+
+            def schedule(chunks):
+                if batch_schedule == "length":
+                    # only look a few batches ahead
+                    nominal_batch_size = controller.batch_size if adaptive else batch_size or 1
+                    indexed = length_bucketed(chunks, window=nominal_batch_size * 8)
+                else:
+                    indexed = enumerate(chunks)
+                for idx, chunk in indexed:
+                    scheduled.append((idx, chunk))
+                    yield chunk
+            scheduled_chunks = schedule(chunks)
+        else:
+            # built before DataLoader workers, which run in other processes, iterate over the chunks
+            scheduled = list(length_bucketed(chunks) if batch_schedule == "length" else enumerate(chunks))
+            scheduled_chunks = [chunk for _, chunk in scheduled]
+        inputs = chunk_inputs(audio, scheduled_chunks, log_frames)
+        # encoder outputs of the first batches, passed to _forward instead of encoding them again
+        encoder_outputs = collections.deque()
+        if self.tokenizer is None and language is None:
+            # detect the language on the first batch of chunks, whose encoding is then reused for ASR
+            first_batch = list(itertools.islice(inputs, controller.batch_size if adaptive else batch_size or 1))
+            if first_batch:
+                features = stack_inputs([self.preprocess(x) for x in first_batch], self._n_mels)['inputs']
+                encoder_output = self.model.encode(features)
+                encoder_outputs.append(encoder_output)
+                language = self.detect_language(audio, encoder_output=encoder_output)
+                first_batch = [{'features': x, 'duration': item.get('duration')} for x, item in zip(features, first_batch)]
+            else:
+                language = self.detect_language(audio)
+            lid_passes += 1
+            inputs = itertools.chain(first_batch, inputs)
+
+        # the tokenizer and options of this call are passed to _forward, the pipeline itself is left
+        # unchanged so that concurrent calls can share it
         if self.tokenizer is None:
             language = language or self.detect_language(audio)
             task = task or "transcribe"
-            self.tokenizer = faster_whisper.tokenizer.Tokenizer(self.model.hf_tokenizer,
-                                                                self.model.model.is_multilingual, task=task,
-                                                                language=language)
         else:
             language = language or self.tokenizer.language_code
             task = task or self.tokenizer.task
-            if task != self.tokenizer.task or language != self.tokenizer.language_code:
-                self.tokenizer = faster_whisper.tokenizer.Tokenizer(self.model.hf_tokenizer,
-                                                                    self.model.model.is_multilingual, task=task,
-                                                                    language=language)
-                
+        tokenizer, options = self._task_context(language, task)
         if self.suppress_numerals:
-            previous_suppress_tokens = self.options.suppress_tokens
-            numeral_symbol_tokens = find_numeral_symbol_tokens(self.tokenizer)
-            print(f"Suppressing numeral and symbol tokens: {numeral_symbol_tokens}")
-            new_suppressed_tokens = numeral_symbol_tokens + self.options.suppress_tokens
-            new_suppressed_tokens = list(set(new_suppressed_tokens))
-            self.options = self.options._replace(suppress_tokens=new_suppressed_tokens)
+            print(f"Suppressing numeral and symbol tokens: {self._numeral_symbol_tokens()}")
 
         segments: List[SingleSegment] = []
-        batch_size = batch_size or self._batch_size
-        total_segments = len(vad_segments)
-        for idx, out in enumerate(self.__call__(data(audio, vad_segments), batch_size=batch_size, num_workers=num_workers)):
+        # (average log probability, compression ratio) of every segment
+        qualities = []
+        batch_stats = [] if return_stats else None
+        call_context = {"batch_stats": batch_stats, "encoder_outputs": encoder_outputs, "tokenizer": tokenizer, "options": options}
+        arena = None
+        if num_workers == 0:
+            # batches collated in DataLoader workers cannot share the buffers of the main process
+            arena = FeatureArena(self._n_mels, controller.batch_size if adaptive else batch_size or 1, pin_memory=self._pin_memory)
+        if adaptive:
+            outputs = self._adaptive_batches(inputs, controller, num_workers, call_context, arena)
+        else:
+            outputs = self._run(inputs, batch_size, num_workers, call_context, arena)
+        for idx, out in enumerate(outputs):
             if print_progress:
-                base_progress = ((idx + 1) / total_segments) * 100
+                if streaming_vad:
+                    # the number of chunks is not known yet, report the position in the file instead
+                    base_progress = scheduled[idx][1]['end'] * SAMPLE_RATE / audio.shape[0] * 100
+                else:
+                    base_progress = ((idx + 1) / len(vad_segments)) * 100
                 percent_complete = base_progress / 2 if combined_progress else base_progress
                 print(f"Progress: {percent_complete:.2f}%...")
             text = out['text']
+            quality = out['quality']
             if batch_size in [0, 1, None]:
                 text = text[0]
+                quality = quality[0]
+            qualities.append(quality)
+            chunk = scheduled[idx][1]
             segments.append(
                 {
                     "text": text,
-                    "start": round(vad_segments[idx]['start'], 3),
-                    "end": round(vad_segments[idx]['end'], 3)
+                    "start": round(chunk['start'], 3),
+                    "end": round(chunk['end'], 3)
                 }
             )
+        if batch_schedule != "time":
+            order = sorted(range(len(segments)), key=lambda i: scheduled[i][0])
+            segments = [segments[i] for i in order]
+            qualities = [qualities[i] for i in order]
+
+        escalated = []
+        if self.cascade_model is not None:
+            escalated = [
+                i for i, (avg_logprob, ratio) in enumerate(qualities)
+                if avg_logprob < cascade_logprob_threshold or ratio > cascade_compression_ratio_threshold
+            ]
+            chunks_in_order = [chunk for _, chunk in sorted(scheduled, key=lambda item: item[0])]
+            cascade_tokenizer, cascade_options = self._task_context(language, task, model=self.cascade_model)
+            cascade_batch_size = controller.batch_size if adaptive else batch_size or 1
+            for first in range(0, len(escalated), cascade_batch_size):
+                batch = escalated[first : first + cascade_batch_size]
+                items = chunk_inputs(audio, [chunks_in_order[i] for i in batch])
+                inputs = stack_inputs([self.preprocess(x) for x in items], model_n_mels(self.cascade_model))
+                texts = self.cascade_model.generate_segment_batched(
+                    inputs['inputs'], cascade_tokenizer, cascade_options, durations=inputs.get('durations')
+                )
+                for i, text in zip(batch, texts):
+                    segments[i]["text"] = text
+
+        if adaptive:
+            try:
+                state = controller.state()
+                save_batch_profile(profile, state.pop("batch_size"), latency_budget=latency_budget, **state)
+            except OSError as e:
+                # an unwritable cache must not cost the transcription
+                warnings.warn(f"Could not save the adaptive batch size: {e}")
+
+        result = {"segments": segments, "language": language}
+        if return_stats:
+            result["stats"] = {
+                "packing": packing_stats(vad_segments, chunk_size, audio_duration=audio.shape[0] / SAMPLE_RATE),
+                "batches": batch_stats,
+                "decode_steps": sum(stats["decode_steps"] for stats in batch_stats),
+                "encoder_passes": lid_passes + sum(stats["encoded"] for stats in batch_stats),
+                "fallbacks": sum(stats["fallbacks"] for stats in batch_stats),
+                "length_capped": sum(stats["length_capped"] for stats in batch_stats),
+            }
+            if adaptive:
+                result["stats"]["batch_size"] = controller.batch_size
+            if arena is not None:
+                # collating a batch used to allocate a padded input per chunk and the stacked batch
+                hours = audio.shape[0] / SAMPLE_RATE / 3600
+                result["stats"]["feature_arena"] = {
+                    "allocations": arena.allocations,
+                    "batches": arena.batches,
+                    "allocations_per_hour": arena.allocations / hours if hours else 0.0,
+                    "stacked_allocations_per_hour": (len(scheduled) + arena.batches) / hours if hours else 0.0,
+                }
+            if self.cascade_model is not None:
+                result["stats"]["cascade"] = {
+                    "escalated": len(escalated),
+                    "escalated_share": len(escalated) / len(segments) if segments else 0.0,
+                }
+            # every chunk is padded to a full window before encoding
+            durations = [chunk_duration(chunk) for _, chunk in scheduled]
+            first = 0
+            for stats in batch_stats:
+                batch_durations = durations[first : first + stats["size"]]
+                first += stats["size"]
+                stats["audio_padding"] = 1 - sum(batch_durations) / (len(batch_durations) * N_SAMPLES / SAMPLE_RATE)
+            # real-time factor: processing time per second of audio
+            seconds = audio.shape[0] / SAMPLE_RATE
+            result["stats"]["rtf"] = (time.perf_counter() - start_time) / seconds if seconds else 0.0
+        return result
+
+    def transcribe_many(
+        self, audios: Iterable[Union[str, np.ndarray]], batch_size=None, language=None, task=None, chunk_size=30, chunk_packing="greedy", max_silence=None, max_wait_files=16
+    ) -> Iterator[TranscriptionResult]:
+        '''
+        Transcribe many audio files, yielding their results in order. Unlike calling `transcribe`
+        on each file, the VAD chunks of all files go to shared batches, so short files with a few
+        chunks each still fill whole batches. Chunks are batched separately per language and task,
+        so every batch is decoded with a single tokenizer prompt; files are transcribed in the
+        language detected on their first chunk unless `language` is given. A partial batch is
+        decoded once its first chunk has waited for `max_wait_files` more files, so a file in a
+        rare language holds back the results after it, and keeps their audio in memory, for at
+        most that many files.
+        '''
+        batch_size = batch_size or self._batch_size or 1
+        task = task or (self.tokenizer.task if self.tokenizer is not None else "transcribe")
+        # per file: its segments, the number still to decode and its language
+        files = []
+        # per (language, task): chunks waiting for a batch, as (file index, segment index, item)
+        queues = collections.defaultdict(list)
+        contexts = {}
+        n_mels = self._n_mels
+        # batches are decoded one at a time, so they can all be collated into the same buffers
+        arena = FeatureArena(n_mels, batch_size, pin_memory=self._pin_memory)
+
+        def run_batch(key):
+            items = queues.pop(key)
+            if key not in contexts:
+                contexts[key] = self._task_context(*key)
+            tokenizer, options = contexts[key]
+            inputs = stack_inputs([self.preprocess(item) for _, _, item in items], n_mels, arena)
+            texts = self.model.generate_segment_batched(inputs['inputs'], tokenizer, options, durations=inputs.get('durations'))
+            for (file_idx, seg_idx, _), text in zip(items, texts):
+                files[file_idx]["segments"][seg_idx]["text"] = text
+                files[file_idx]["remaining"] -= 1
 
-        # revert the tokenizer if multilingual inference is enabled
-        if self.preset_language is None:
-            self.tokenizer = None
+        next_idx = 0
 
-        # revert suppressed tokens if suppress_numerals is enabled
+        def pop_finished():
+            # results of the files done so far, keeping the input order
+            nonlocal next_idx
+            results = []
+            while next_idx < len(files) and files[next_idx]["remaining"] == 0:
+                file = files[next_idx]
+                files[next_idx] = None
+                next_idx += 1
+                results.append({"segments": file["segments"], "language": file["language"]})
+            return results
+
+        for audio in audios:
+            if isinstance(audio, str):
+                audio = load_audio(audio)
+            vad_segments = self.vad_model({"waveform": torch.from_numpy(audio).unsqueeze(0), "sample_rate": SAMPLE_RATE})
+            chunks = merge_chunks(
+                vad_segments,
+                chunk_size,
+                onset=self._vad_params["vad_onset"],
+                offset=self._vad_params["vad_offset"],
+                packing=chunk_packing,
+                max_silence=max_silence,
+            )
+            file_language = language or (self.tokenizer.language_code if self.tokenizer is not None else None)
+            if file_language is None:
+                if chunks:
+                    features = stack_inputs([self.preprocess(x) for x in chunk_inputs(audio, chunks[:1])], n_mels)['inputs']
+                    file_language = self.detect_language(audio, encoder_output=self.model.encode(features))
+                else:
+                    file_language = self.detect_language(audio)
+
+            file_idx = len(files)
+            files.append({
+                "segments": [
+                    {"text": "", "start": round(chunk['start'], 3), "end": round(chunk['end'], 3)} for chunk in chunks
+                ],
+                "remaining": len(chunks),
+                "language": file_language,
+            })
+            key = (file_language, task)
+            for seg_idx, item in enumerate(chunk_inputs(audio, chunks)):
+                queues[key].append((file_idx, seg_idx, item))
+                if len(queues[key]) == batch_size:
+                    run_batch(key)
+            for key in [key for key, queue in queues.items() if file_idx - queue[0][0] >= max_wait_files]:
+                run_batch(key)
+            yield from pop_finished()
+
+        # decode the partial batches left over
+        for key in list(queues):
+            run_batch(key)
+        yield from pop_finished()
+
+    def _task_context(self, language: str, task: str, model: Optional[WhisperModel] = None):
+        """
+        Tokenizer and decoding options to transcribe `language` with `task` using `model`, by
+        default the pipeline's model, leaving the pipeline unchanged.
+        """
+        model = model or self.model
+        tokenizer = self._get_tokenizer(language, task, model)
+        options = self.options
         if self.suppress_numerals:
-            self.options = self.options._replace(suppress_tokens=previous_suppress_tokens)
+            options = options._replace(suppress_tokens=self._merged_suppress_tokens(options.suppress_tokens, model))
+        return tokenizer, options
+
+    def _get_tokenizer(self, language: str, task: str, model: Optional[WhisperModel] = None) -> faster_whisper.tokenizer.Tokenizer:
+        model = model or self.model
+        key = (id(model), language, task)
+        with self._cache_lock:
+            if key not in self._tokenizers:
+                self._tokenizers[key] = faster_whisper.tokenizer.Tokenizer(model.hf_tokenizer,
+                                                                           model.model.is_multilingual, task=task,
+                                                                           language=language)
+            return self._tokenizers[key]
 
-        return {"segments": segments, "language": language}
+    def _numeral_symbol_tokens(self, model: Optional[WhisperModel] = None) -> List[int]:
+        # the same for every language and task, as it only depends on the vocabulary
+        model = model or self.model
+        if id(model) not in self._numeral_symbol_token_lists:
+            tokenizer = self._get_tokenizer("en", "transcribe", model)
+            with self._cache_lock:
+                if id(model) not in self._numeral_symbol_token_lists:
+                    self._numeral_symbol_token_lists[id(model)] = load_numeral_symbol_tokens(tokenizer)
+        return self._numeral_symbol_token_lists[id(model)]
 
+    def _merged_suppress_tokens(self, suppress_tokens: List[int], model: Optional[WhisperModel] = None) -> List[int]:
+        """`suppress_tokens` with the numeral and symbol tokens of `model` added, computed once per list."""
+        model = model or self.model
+        key = (id(model), tuple(suppress_tokens))
+        numeral_symbol_tokens = self._numeral_symbol_tokens(model)
+        with self._cache_lock:
+            if key not in self._suppress_token_lists:
+                self._suppress_token_lists[key] = list(set(numeral_symbol_tokens + list(suppress_tokens)))
+            return self._suppress_token_lists[key]
 
-    def detect_language(self, audio: np.ndarray):
-        if audio.shape[0] < N_SAMPLES:
-            print("Warning: audio is shorter than 30s, language detection may be inaccurate.")
-        model_n_mels = self.model.feat_kwargs.get("feature_size")
-        segment = log_mel_spectrogram(audio[: N_SAMPLES],
-                                      n_mels=model_n_mels if model_n_mels is not None else 80,
-                                      padding=0 if audio.shape[0] >= N_SAMPLES else N_SAMPLES - audio.shape[0])
-        encoder_output = self.model.encode(segment)
+    def _run(self, inputs, batch_size, num_workers: int, forward_params: dict, arena: Optional[FeatureArena] = None):
+        """
+        Run the pipeline on `inputs` with per-call `forward_params`, like `__call__` but without
+        updating the pipeline's call counter or default parameters, so it is safe to call from
+        several threads at once. Batches are collated into `arena` if given.
+        """
+        forward_params = {**self._forward_params, **forward_params}
+        return self.get_iterator(
+            inputs, num_workers, batch_size or 1, self._preprocess_params, forward_params, self._postprocess_params, arena
+        )
+
+    def _adaptive_batches(self, inputs, controller: AdaptiveBatchSize, num_workers: int, forward_params: dict, arena: Optional[FeatureArena] = None):
+        # run the pipeline one batch at a time, each sized by `controller` from the latency of the previous ones
+        batch_stats = forward_params["batch_stats"]
+        encoder_outputs = forward_params["encoder_outputs"]
+        inputs = iter(inputs)
+        while True:
+            batch = list(itertools.islice(inputs, controller.batch_size))
+            if not batch:
+                return
+            # a batch encoded ahead of time is faster than usual and says little about its size
+            precomputed = bool(encoder_outputs)
+            start_time = time.perf_counter()
+            outputs = list(self._run(batch, len(batch), num_workers, forward_params, arena))
+            latency = time.perf_counter() - start_time
+            if not precomputed:
+                controller.update(len(batch), latency)
+            if batch_stats is not None:
+                batch_stats[-1]["latency"] = latency
+            for out in outputs:
+                if len(batch) == 1:
+                    # a batch of one is not unbatched by the pipeline
+                    out = {'text': out['text'][0], 'quality': out['quality'][0]}
+                yield out
+
+    def detect_language(self, audio: np.ndarray, encoder_output: Optional[ctranslate2.StorageView] = None, weights: Optional[List[float]] = None):
+        """
+        Detect the language of the first 30s of `audio`, or of the first window of `encoder_output`
+        if given, e.g. the encoding of the first batch of VAD chunks. If `weights` are given, the
+        language probabilities of the first len(weights) windows of `encoder_output` are averaged
+        with these weights instead.
+        """
+        if encoder_output is None:
+            if audio.shape[0] < N_SAMPLES:
+                print("Warning: audio is shorter than 30s, language detection may be inaccurate.")
+            segment = log_mel_spectrogram(audio[: N_SAMPLES],
+                                          n_mels=self._n_mels,
+                                          padding=0 if audio.shape[0] >= N_SAMPLES else N_SAMPLES - audio.shape[0])
+            encoder_output = self.model.encode(segment)
+            where = "first 30s of audio"
+        elif weights is None:
+            where = "first chunk of speech"
+        else:
+            where = f"{len(weights)} chunks of speech"
         results = self.model.model.detect_language(encoder_output)
-        language_token, language_probability = results[0][0]
+        if weights is None:
+            language_token, language_probability = results[0][0]
+        else:
+            total = sum(weights)
+            weights = [weight / total for weight in weights] if total > 0 else [1 / len(weights)] * len(weights)
+            votes = collections.defaultdict(float)
+            for result, weight in zip(results, weights):
+                for token, probability in result:
+                    votes[token] += probability * weight
+            language_token, language_probability = max(votes.items(), key=lambda vote: vote[1])
         language = language_token[2:-2]
-        print(f"Detected language: {language} ({language_probability:.2f}) in first 30s of audio...")
+        print(f"Detected language: {language} ({language_probability:.2f}) in {where}...")
         return language
 
 def load_model(whisper_arch,
@@ -267,7 +972,8 @@ def load_model(whisper_arch,
                model : Optional[WhisperModel] = None,
                task="transcribe",
                download_root=None,
-               threads=4):
+               threads=4,
+               cascade_model: Optional[str] = None):
     '''Load a Whisper model for inference.
     Args:
         whisper_arch: str - The name of the Whisper model to load.
@@ -275,9 +981,13 @@ def load_model(whisper_arch,
         compute_type: str - The compute type to use for the model.
         options: dict - A dictionary of options to use for the model.
         language: str - The language of the model. (use English for now)
+        vad_model: Optional[Callable] - The VAD backend to use, called with {"waveform": Tensor, "sample_rate": int}
+            and returning frame speech scores as a SlidingWindowFeature, e.g. `vad.EnergyVAD()`.
+        vad_options: dict - Options of `load_vad_model`, used when `vad_model` is None; "vad_method" selects the backend.
         model: Optional[WhisperModel] - The WhisperModel instance to use.
         download_root: Optional[str] - The root directory to download the model to.
         threads: int - The number of cpu threads to use per worker, e.g. will be multiplied by num workers.
+        cascade_model: Optional[str] - The name of a larger Whisper model to re-decode low-confidence chunks with.
     Returns:
         A Whisper pipeline.
     '''
@@ -291,6 +1001,13 @@ def load_model(whisper_arch,
                          compute_type=compute_type,
                          download_root=download_root,
                          cpu_threads=threads)
+    if cascade_model is not None:
+        cascade_model = WhisperModel(cascade_model,
+                                     device=device,
+                                     device_index=device_index,
+                                     compute_type=compute_type,
+                                     download_root=download_root,
+                                     cpu_threads=threads)
     if language is not None:
         tokenizer = faster_whisper.tokenizer.Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task=task, language=language)
     else:
@@ -351,4 +1068,6 @@ def load_model(whisper_arch,
         language=language,
         suppress_numerals=suppress_numerals,
         vad_params=default_vad_options,
+        batch_profile=f"{whisper_arch}-{device}-{compute_type}",
+        cascade_model=cascade_model,
     )
@@ -1,12 +1,15 @@
 import os
+import struct
 import subprocess
+import tempfile
 from functools import lru_cache
-from typing import Optional, Union
+from typing import Iterator, Optional, Union
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 
+from .cache import DiskCache, file_sha256
 from .utils import exact_div
 
 # hard-coded audio hyperparameters
@@ -21,11 +24,178 @@ N_SAMPLES_PER_TOKEN = HOP_LENGTH * 2  # the initial convolutions has stride 2
 FRAMES_PER_SECOND = exact_div(SAMPLE_RATE, HOP_LENGTH)  # 10ms per audio frame
 TOKENS_PER_SECOND = exact_div(SAMPLE_RATE, N_SAMPLES_PER_TOKEN)  # 20ms per audio token
 
+# opt-in on-disk cache of decoded waveforms, see set_audio_cache
+_audio_cache: Optional[DiskCache] = None
+
+
+def _ffmpeg_decode_cmd(file: str, sr: int):
+    # Down-mix to mono and resample to `sr` Hz, writing raw 16-bit PCM to stdout.
+    return [
+        "ffmpeg",
+        "-nostdin",
+        "-threads",
+        "0",
+        "-i",
+        file,
+        "-f",
+        "s16le",
+        "-ac",
+        "1",
+        "-acodec",
+        "pcm_s16le",
+        "-ar",
+        str(sr),
+        "-",
+    ]
+
+
+def _iter_pcm_blocks(file: str, sr: int, block_size: int) -> Iterator[np.ndarray]:
+    """
+    Run ffmpeg on `file` and yield its int16 output in blocks of at most `block_size` samples,
+    so that the full PCM stream is never buffered in memory.
+    """
+    # stderr goes to a temporary file rather than a pipe: ffmpeg keeps writing progress
+    # lines while we read stdout, and a full stderr pipe would deadlock the decoder.
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(_ffmpeg_decode_cmd(file, sr), stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            while True:
+                data = process.stdout.read(block_size * 2)
+                if not data:
+                    break
+                yield np.frombuffer(data, np.int16, count=len(data) // 2)
+        except GeneratorExit:
+            # the consumer stopped early, there is no point in decoding the rest
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+
+        if returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"Failed to load audio: {stderr.read().decode()}")
+
+
+def load_audio_stream(file: str, sr: int = SAMPLE_RATE, block_size: int = N_SAMPLES) -> Iterator[np.ndarray]:
+    """
+    Open an audio file and yield it as consecutive mono waveform blocks, resampling as necessary
+
+    Parameters
+    ----------
+    file: str
+        The audio file to open
+
+    sr: int
+        The sample rate to resample the audio if necessary
+
+    block_size: int
+        The maximum number of samples per yielded block, 30 seconds by default
+
+    Returns
+    -------
+    An iterator of NumPy arrays containing the audio waveform, in float32 dtype.
+    """
+    for pcm in _iter_pcm_blocks(file, sr, block_size):
+        yield _pcm_to_float(pcm)
+
+
+def set_audio_cache(cache_dir: Optional[str], max_size: Optional[int] = None):
+    """
+    Enable or disable the on-disk cache of decoded audio used by `load_audio`
+
+    Parameters
+    ----------
+    cache_dir: Optional[str]
+        The directory to store decoded waveforms in, or None to disable the cache
+
+    max_size: Optional[int]
+        The maximum size of the cache in bytes, least recently used entries are evicted beyond it
+    """
+    global _audio_cache
+    _audio_cache = DiskCache(cache_dir, max_size=max_size) if cache_dir is not None else None
+
+
+def _pcm_to_float(pcm: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    # int16 -> float32 scaling in a single vectorized pass, exact since every int16 value
+    # divided by 2**15 is representable in float32
+    if out is None:
+        out = np.empty(pcm.shape, dtype=np.float32)
+    return np.divide(pcm, np.float32(32768.0), out=out)
+
+
+def _read_wav_pcm(file: str, sr: int) -> Optional[np.ndarray]:
+    """
+    Memory-map the samples of `file` if it is a mono 16-bit PCM WAV file at `sr` Hz, i.e. a file
+    ffmpeg would pass through unchanged. Returns None for anything else.
+    """
+    try:
+        with open(file, "rb") as f:
+            header = f.read(12)
+            if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+                return None
+
+            fmt_ok = False
+            while True:
+                chunk_header = f.read(8)
+                if len(chunk_header) < 8:
+                    return None
+                chunk_id = chunk_header[:4]
+                (chunk_size,) = struct.unpack("<I", chunk_header[4:])
+                if chunk_id == b"data":
+                    break
+                if chunk_id == b"fmt ":
+                    fmt = f.read(chunk_size)
+                    if len(fmt) < 16:
+                        return None
+                    format_tag, channels, rate, _, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+                    if format_tag == 0xFFFE and len(fmt) >= 26:
+                        # WAVE_FORMAT_EXTENSIBLE, the sub-format GUID starts with the format tag
+                        (format_tag,) = struct.unpack("<H", fmt[24:26])
+                    fmt_ok = (format_tag, channels, rate, bits) == (1, 1, sr, 16)
+                    if not fmt_ok:
+                        return None
+                    f.seek(chunk_size & 1, os.SEEK_CUR)
+                else:
+                    # chunks are word-aligned
+                    f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+            data_offset = f.tell()
+            file_size = os.fstat(f.fileno()).st_size
+    except OSError:
+        return None
+
+    # leave streamed (unknown length) and truncated files to ffmpeg
+    if not fmt_ok or chunk_size < 2 or chunk_size == 0xFFFFFFFF or data_offset + chunk_size > file_size:
+        return None
+    return np.memmap(file, dtype="<i2", mode="r", offset=data_offset, shape=(chunk_size // 2,))
+
+
+def _decode_audio(file: str, sr: int) -> np.ndarray:
+    # Decoded blocks are converted in place into a single float32 buffer. The buffer is grown
+    # with ndarray.resize (realloc), which large allocations satisfy by remapping pages rather
+    # than copying, so peak memory stays close to the size of the returned waveform.
+    audio = np.empty(N_SAMPLES, dtype=np.float32)
+    num_samples = 0
+    for pcm in _iter_pcm_blocks(file, sr, N_SAMPLES):
+        end = num_samples + pcm.shape[0]
+        if end > audio.shape[0]:
+            audio.resize(max(end, audio.shape[0] * 3 // 2), refcheck=False)
+        _pcm_to_float(pcm, out=audio[num_samples:end])
+        num_samples = end
+    audio.resize(num_samples, refcheck=False)
+    return audio
+
 
 def load_audio(file: str, sr: int = SAMPLE_RATE):
     """
     Open an audio file and read as mono waveform, resampling as necessary
 
+    Mono 16-bit PCM WAV files already at `sr` Hz are read directly without running ffmpeg. For
+    other inputs, if an audio cache is enabled with `set_audio_cache`, the decoded waveform is
+    stored on disk keyed by the file content and sample rate, and later loads of the same content
+    return a memory-mapped array without decoding.
+
     Parameters
     ----------
     file: str
@@ -38,31 +208,29 @@ def load_audio(file: str, sr: int = SAMPLE_RATE):
     -------
     A NumPy array containing the audio waveform, in float32 dtype.
     """
-    try:
-        # Launches a subprocess to decode audio while down-mixing and resampling as necessary.
-        # Requires the ffmpeg CLI to be installed.
-        cmd = [
-            "ffmpeg",
-            "-nostdin",
-            "-threads",
-            "0",
-            "-i",
-            file,
-            "-f",
-            "s16le",
-            "-ac",
-            "1",
-            "-acodec",
-            "pcm_s16le",
-            "-ar",
-            str(sr),
-            "-",
-        ]
-        out = subprocess.run(cmd, capture_output=True, check=True).stdout
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
-
-    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+    pcm = _read_wav_pcm(file, sr)
+    if pcm is not None:
+        return _pcm_to_float(pcm)
+
+    cache = _audio_cache
+    if cache is None:
+        return _decode_audio(file, sr)
+
+    # The waveform is cached as float32 rather than int16 so a hit can be returned as the memmap
+    # itself; converting int16 would mean a full in-memory copy on every load.
+    key = f"{file_sha256(file)}-{sr}.npy"
+    path = cache.get(key)
+    if path is None:
+        audio = _decode_audio(file, sr)
+        cache.put(key, lambda tmp_path: _save_npy(tmp_path, audio))
+        return audio
+    # copy-on-write mapping: callers get a writable array, the cache file is never modified
+    return np.load(path, mmap_mode="c")
+
+
+def _save_npy(path: str, array: np.ndarray):
+    with open(path, "wb") as f:
+        np.save(f, array)
 
 
 def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
@@ -109,6 +277,14 @@ def mel_filters(device, n_mels: int) -> torch.Tensor:
         return torch.from_numpy(f[f"mel_{n_mels}"]).to(device)
 
 
+@lru_cache(maxsize=None)
+def hann_window(device) -> torch.Tensor:
+    """
+    The STFT window, cached per device like the mel filterbank.
+    """
+    return torch.hann_window(N_FFT).to(device)
+
+
 def log_mel_spectrogram(
     audio: Union[str, np.ndarray, torch.Tensor],
     n_mels: int,
@@ -146,7 +322,7 @@ def log_mel_spectrogram(
         audio = audio.to(device)
     if padding > 0:
         audio = F.pad(audio, (0, padding))
-    window = torch.hann_window(N_FFT).to(audio.device)
+    window = hann_window(audio.device)
     stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=window, return_complex=True)
     magnitudes = stft[..., :-1].abs() ** 2
 
@@ -157,3 +333,138 @@ def log_mel_spectrogram(
     log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
     log_spec = (log_spec + 4.0) / 4.0
     return log_spec
+
+
+def log_mel_spectrogram_batch(
+    audio: torch.Tensor,
+    n_mels: int,
+    device: Optional[Union[str, torch.device]] = None,
+):
+    """
+    Compute the log-Mel spectrograms of a batch of equal-length waveforms with a single STFT and
+    filterbank product. Each item is normalised on its own, so the result equals stacking
+    `log_mel_spectrogram` of every item.
+
+    Parameters
+    ----------
+    audio: torch.Tensor, shape = (batch_size, n_samples)
+        A Tensor containing the audio waveforms in 16 kHz, typically padded to N_SAMPLES
+
+    n_mels: int
+        The number of Mel-frequency filters
+
+    device: Optional[Union[str, torch.device]]
+        If given, the audio tensor is moved to this device before STFT
+
+    Returns
+    -------
+    torch.Tensor, shape = (batch_size, n_mels, n_frames)
+        A Tensor that contains the Mel spectrograms
+    """
+    if device is not None:
+        audio = audio.to(device)
+    stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=hann_window(audio.device), return_complex=True)
+    magnitudes = stft[..., :-1].abs() ** 2
+
+    mel_spec = mel_filters(audio.device, n_mels) @ magnitudes
+
+    log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+    log_spec = torch.maximum(log_spec, log_spec.amax(dim=(-2, -1), keepdim=True) - 8.0)
+    log_spec = (log_spec + 4.0) / 4.0
+    return log_spec
+
+
+def log_mel_frames(
+    audio: Union[np.ndarray, torch.Tensor],
+    n_mels: int,
+    block_frames: int = 10 * N_FRAMES,
+    device: Optional[Union[str, torch.device]] = None,
+):
+    """
+    Compute the un-normalised log-Mel frames of a whole waveform, block by block, so that chunks of
+    it can later be turned into model inputs with `log_mel_chunk` without repeating the STFT.
+
+    Parameters
+    ----------
+    audio: Union[np.ndarray, torch.Tensor], shape = (n_samples,)
+        A NumPy array or Tensor containing the audio waveform in 16 kHz
+
+    n_mels: int
+        The number of Mel-frequency filters
+
+    block_frames: int
+        The number of frames computed per STFT call, bounding the size of the intermediate spectrum
+
+    device: Optional[Union[str, torch.device]]
+        If given, the STFT of each block is computed on this device
+
+    Returns
+    -------
+    torch.Tensor, shape = (n_mels, n_samples // HOP_LENGTH)
+        The log10 Mel power of every frame, on the CPU
+    """
+    if not torch.is_tensor(audio):
+        audio = torch.from_numpy(audio)
+    device = audio.device if device is None else torch.device(device)
+
+    num_samples = audio.shape[-1]
+    num_frames = num_samples // HOP_LENGTH
+    window = hann_window(device)
+    filters = mel_filters(device, n_mels)
+    log_spec = torch.empty((n_mels, num_frames), dtype=torch.float32)
+
+    pad = N_FFT // 2
+    for first in range(0, num_frames, block_frames):
+        last = min(first + block_frames, num_frames)
+        # frame k is centred on sample k * HOP_LENGTH, covering [k * HOP_LENGTH - pad, k * HOP_LENGTH + pad)
+        start = first * HOP_LENGTH - pad
+        end = (last - 1) * HOP_LENGTH + pad
+        block = audio[max(start, 0) : min(end, num_samples)].to(device)
+        if start < 0 or end > num_samples:
+            # reflect at the edges of the file, as the centered STFT of log_mel_spectrogram does;
+            # a file shorter than the padding cannot be reflected, and is zero padded instead
+            padding = (max(-start, 0), max(end - num_samples, 0))
+            mode = "reflect" if max(padding) < block.shape[-1] else "constant"
+            block = F.pad(block[None], padding, mode=mode)[0]
+        stft = torch.stft(block, N_FFT, HOP_LENGTH, window=window, center=False, return_complex=True)
+        mel_spec = filters @ (stft.abs() ** 2)
+        log_spec[:, first:last] = torch.clamp(mel_spec, min=1e-10).log10().cpu()
+
+    return log_spec
+
+
+def log_mel_chunk(log_frames: torch.Tensor, start: int, end: int):
+    """
+    Build the model input for audio samples [start, end) from the frames of `log_mel_frames`,
+    padded to N_FRAMES and normalised per chunk like `log_mel_spectrogram`.
+
+    The result matches `log_mel_spectrogram(audio[start:end], padding=N_SAMPLES - (end - start))`
+    except at the first two frames of the chunk, its last frame and the two frames after it, where
+    the latter sees reflect and zero padding instead of the neighbouring audio, and `start` is
+    rounded to the nearest frame.
+
+    Parameters
+    ----------
+    log_frames: torch.Tensor, shape = (n_mels, n_frames)
+        The output of `log_mel_frames` for the whole waveform
+
+    start: int
+        The first sample of the chunk
+
+    end: int
+        The sample after the last sample of the chunk
+
+    Returns
+    -------
+    torch.Tensor, shape = (n_mels, N_FRAMES)
+        A Tensor that contains the Mel spectrogram
+    """
+    first = round(start / HOP_LENGTH)
+    frames = log_frames[:, first : first + min(-(-(end - start) // HOP_LENGTH), N_FRAMES)]
+
+    # the zero padding after the chunk is clamped to log10(1e-10)
+    log_spec = torch.full((log_frames.shape[0], N_FRAMES), -10.0, dtype=log_frames.dtype)
+    log_spec[:, : frames.shape[1]] = frames
+    log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+    log_spec = (log_spec + 4.0) / 4.0
+    return log_spec
@@ -0,0 +1,255 @@
+import collections
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import torch
+
+from .cache import DEFAULT_CACHE_DIR
+
+BATCH_PROFILES_PATH = os.path.join(DEFAULT_CACHE_DIR, "batch_sizes.json")
+
+
+def load_batch_profiles(path: str = BATCH_PROFILES_PATH) -> dict:
+    """Batch sizes chosen by `AdaptiveBatchSize` in previous runs, keyed by profile."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_batch_profile(profile: str, batch_size: int, path: str = BATCH_PROFILES_PATH, **info):
+    """Record the batch size chosen for `profile`, along with any `info` describing it."""
+    profiles = load_batch_profiles(path)
+    profiles[profile] = {"batch_size": batch_size, **info}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(profiles, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class AdaptiveBatchSize:
+    """
+    Choose the batch size from the latency of the batches run so far: starting from `initial`, the
+    batch size is doubled while throughput improves and the latency expected for the larger batch
+    fits in `latency_budget`, reduced when a batch exceeds the budget, and otherwise kept at the
+    size with the best measured throughput.
+
+    Parameters
+    ----------
+    latency_budget: float
+        The maximum time in seconds a batch may take
+
+    initial: int
+        The batch size to start from, e.g. the one chosen in a previous run
+
+    min_size, max_size: int
+        The range of batch sizes to choose from
+
+    smoothing: float
+        The weight of a new measurement in the running throughput of its batch size
+    """
+
+    def __init__(
+        self,
+        latency_budget: float = 10.0,
+        initial: int = 8,
+        min_size: int = 1,
+        max_size: int = 64,
+        smoothing: float = 0.3,
+    ):
+        assert 1 <= min_size <= max_size
+        self.latency_budget = latency_budget
+        self.min_size = min_size
+        self.max_size = max_size
+        self.smoothing = smoothing
+        self.batch_size = min(max(initial, min_size), max_size)
+        # running throughput in items per second of every batch size tried
+        self.throughput = {}
+        # smallest batch size found to exceed the latency budget
+        self._limit = max_size + 1
+
+    def update(self, size: int, latency: float):
+        """Record that a batch of `size` items took `latency` seconds and pick the next batch size."""
+        if size < self.batch_size:
+            # a partial batch, e.g. the last one of a file, says little about the chosen size
+            return
+        throughput = size / max(latency, 1e-9)
+        previous = self.throughput.get(size)
+        self.throughput[size] = throughput if previous is None else (1 - self.smoothing) * previous + self.smoothing * throughput
+
+        if latency > self.latency_budget:
+            self._limit = min(self._limit, size)
+            self.throughput.pop(size)
+            self.batch_size = max(self.min_size, min(size * 3 // 4, size - 1))
+            return
+
+        best = max(self.throughput, key=self.throughput.get)
+        larger = min(size * 2, self.max_size, self._limit - 1)
+        if best == size and larger > size and larger not in self.throughput and latency * larger / size <= self.latency_budget:
+            # probe a larger batch while it still pays off
+            self.batch_size = larger
+        else:
+            self.batch_size = best
+
+    def state(self) -> dict:
+        """The measured batch size with the best throughput, and the size found to exceed the budget."""
+        if not self.throughput:
+            return {"batch_size": self.batch_size, "throughput": None, "limit": self._limit}
+        best = max(self.throughput, key=self.throughput.get)
+        return {"batch_size": best, "throughput": self.throughput[best], "limit": self._limit}
+
+
+class BatchingEngine:
+    """
+    Batch transcription requests from concurrent callers into shared calls to
+    `WhisperModel.generate_segment_batched`, so a model serving many small requests still runs
+    full batches. Callers `submit` the features of a chunk with the tokenizer and options to
+    decode it with and get a future of its text back. Dispatcher threads batch pending chunks
+    that share the same tokenizer and options, as soon as `max_batch_size` of them are waiting or
+    the oldest one has waited `max_wait` seconds.
+
+    Parameters
+    ----------
+    model: WhisperModel
+        The model to decode with, see `asr.WhisperModel`
+
+    max_batch_size: int
+        The maximum number of chunks per batch
+
+    max_wait: float
+        The maximum time in seconds a chunk waits for its batch to fill up
+
+    num_threads: int
+        The number of batches decoded at once, e.g. the number of model replicas
+
+    Examples
+    --------
+    >>> with BatchingEngine(pipeline.model, max_batch_size=16) as engine:
+    ...     future = engine.submit(features, tokenizer, pipeline.options)
+    ...     text = future.result()
+    """
+
+    def __init__(self, model, max_batch_size: int = 8, max_wait: float = 0.05, num_threads: int = 1):
+        assert max_batch_size >= 1 and num_threads >= 1
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # pending chunks per (tokenizer, options), as (features, future, submit time)
+        self._queues = collections.OrderedDict()
+        self._contexts = {}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._metrics = {"requests": 0, "batches": 0, "queue_latency_total": 0.0, "queue_latency_max": 0.0}
+        self._threads = [
+            threading.Thread(target=self._dispatch, name=f"whisperx-batching-{i}", daemon=True) for i in range(num_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, features, tokenizer, options) -> concurrent.futures.Future:
+        """Queue the log-Mel `features` of one chunk, shape (n_mels, N_FRAMES), for decoding."""
+        future = concurrent.futures.Future()
+        # options are a NamedTuple holding lists, so they are keyed by value
+        key = (id(tokenizer), repr(options))
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("BatchingEngine is closed")
+            self._contexts[key] = (tokenizer, options)
+            self._queues.setdefault(key, []).append((features, future, time.perf_counter()))
+            self._metrics["requests"] += 1
+            self._condition.notify()
+        return future
+
+    def _next_batch(self):
+        # a full queue if there is one, else the one whose oldest chunk has waited longest;
+        # returns the batch, or None and the time to wait for one
+        now = time.perf_counter()
+        oldest_key, oldest_time = None, None
+        for key, queue in self._queues.items():
+            if len(queue) >= self.max_batch_size:
+                oldest_key = key
+                break
+            if oldest_time is None or queue[0][2] < oldest_time:
+                oldest_key, oldest_time = key, queue[0][2]
+        if oldest_key is None:
+            return None, None
+        queue = self._queues[oldest_key]
+        if len(queue) < self.max_batch_size and now - oldest_time < self.max_wait and not self._closed:
+            return None, self.max_wait - (now - oldest_time)
+        batch, rest = queue[: self.max_batch_size], queue[self.max_batch_size :]
+        context = self._contexts[oldest_key]
+        if rest:
+            self._queues[oldest_key] = rest
+        else:
+            del self._queues[oldest_key]
+            del self._contexts[oldest_key]
+        return (context, batch), None
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while True:
+                    batch, timeout = self._next_batch()
+                    if batch is not None or (self._closed and not self._queues):
+                        break
+                    self._condition.wait(timeout)
+                if batch is None:
+                    return
+                (tokenizer, options), items = batch
+                now = time.perf_counter()
+                latencies = [now - submitted for _, _, submitted in items]
+                self._metrics["batches"] += 1
+                self._metrics["queue_latency_total"] += sum(latencies)
+                self._metrics["queue_latency_max"] = max(self._metrics["queue_latency_max"], *latencies)
+
+            features = [x for x, _, _ in items]
+            features = torch.stack(features) if torch.is_tensor(features[0]) else np.stack(features)
+            try:
+                texts = self.model.generate_segment_batched(features, tokenizer, options)
+            except BaseException as e:
+                for _, future, _ in items:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), text in zip(items, texts):
+                future.set_result(text)
+
+    def metrics(self) -> dict:
+        """Batch fill and queue latency of the chunks dispatched so far."""
+        with self._condition:
+            metrics = dict(self._metrics)
+            pending = sum(len(queue) for queue in self._queues.values())
+        dispatched = metrics["requests"] - pending
+        return {
+            "requests": metrics["requests"],
+            "pending": pending,
+            "batches": metrics["batches"],
+            "batch_fill": dispatched / (metrics["batches"] * self.max_batch_size) if metrics["batches"] else 0.0,
+            "queue_latency_mean": metrics["queue_latency_total"] / dispatched if dispatched else 0.0,
+            "queue_latency_max": metrics["queue_latency_max"],
+        }
+
+    def close(self):
+        """Decode the chunks still pending and stop the dispatcher threads."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
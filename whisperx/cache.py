@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Callable, Optional
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "whisperx")
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """
+    SHA-256 hex digest of a file's content, read in blocks so large media files are never fully
+    loaded in memory.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def array_sha256(array) -> str:
+    """
+    SHA-256 hex digest of the content of a contiguous array or tensor, e.g. a decoded waveform.
+    """
+    if hasattr(array, "numpy"):
+        array = array.detach().cpu().numpy()
+    return hashlib.sha256(memoryview(array).cast("B")).hexdigest()
+
+
+def verify_file(path: str, checksum: str) -> bool:
+    """
+    Check that the SHA-256 of the file at `path` is `checksum`, hashing it only once: a successful
+    check is recorded in a "<path>.verified" sidecar keyed by the file's size, mtime and inode, and
+    later calls only compare those.
+    """
+    stat = os.stat(path)
+    marker = {"sha256": checksum, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino}
+    marker_path = path + ".verified"
+    try:
+        with open(marker_path) as f:
+            if json.load(f) == marker:
+                return True
+    except (OSError, ValueError):
+        pass
+
+    if file_sha256(path) != checksum:
+        return False
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(marker_path) or ".", prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(marker, f)
+        os.replace(tmp_path, marker_path)
+    except OSError:
+        # a read-only model directory only costs re-hashing on the next load
+        pass
+    return True
+
+
+class DiskCache:
+    """
+    A directory of cache entries, one file per key, with least-recently-used eviction once the
+    total size exceeds `max_size` bytes. Recency is tracked through the entries' mtime, which is
+    refreshed on every hit, so the cache can be shared by several processes.
+
+    Parameters
+    ----------
+    cache_dir: str
+        The directory holding the cache entries, created if missing
+
+    max_size: Optional[int]
+        The maximum total size of the entries in bytes, unbounded if None
+    """
+
+    def __init__(self, cache_dir: str, max_size: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return the path of the entry for `key` and mark it as recently used, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, write: Callable[[str], None]) -> str:
+        """
+        Create the entry for `key` by calling `write` with a temporary path, then atomically move it
+        in place so concurrent readers never see a partial entry. Returns the path of the entry.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict(keep=key)
+        return self.path(key)
+
+    def evict(self, keep: Optional[str] = None):
+        """
+        Remove the least recently used entries until the cache fits in `max_size` bytes.
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith(".tmp-") or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
@@ -1,6 +1,5 @@
 import numpy as np
 import pandas as pd
-from pyannote.audio import Pipeline
 from typing import Optional, Union
 import torch
 
@@ -14,6 +13,9 @@ class DiarizationPipeline:
         use_auth_token=None,
         device: Optional[Union[str, torch.device]] = "cpu",
     ):
+        # imported here so transcription alone does not need pyannote.audio
+        from pyannote.audio import Pipeline
+
         if isinstance(device, str):
             device = torch.device(device)
         self.model = Pipeline.from_pretrained(model_name, use_auth_token=use_auth_token).to(device)
@@ -8,7 +8,7 @@ import torch
 
 from .alignment import align, load_align_model
 from .asr import load_model
-from .audio import load_audio
+from .audio import load_audio, set_audio_cache
 from .diarize import DiarizationPipeline, assign_word_speakers
 from .utils import (LANGUAGES, TO_LANGUAGE_CODE, get_writer, optional_float,
                     optional_int, str2bool)
@@ -28,12 +28,15 @@ def cli():
     parser.add_argument("--model_dir", type=str, default=None, help="the path to save model files; uses ~/.cache/whisper by default")
     parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="device to use for PyTorch inference")
     parser.add_argument("--device_index", default=0, type=int, help="device index to use for FasterWhisper inference")
-    parser.add_argument("--batch_size", default=8, type=int, help="the preferred batch size for inference")
+    parser.add_argument("--batch_size", default=8, type=lambda x: x if x == "auto" else int(x), help="the preferred batch size for inference, or 'auto' to adapt it to the measured batch latency and remember it for the model")
+    parser.add_argument("--latency_budget", default=10.0, type=float, help="with --batch_size auto, the maximum time in seconds a batch may take")
     parser.add_argument("--compute_type", default="float16", type=str, choices=["float16", "float32", "int8"], help="compute type for computation")
 
     parser.add_argument("--output_dir", "-o", type=str, default=".", help="directory to save the outputs")
     parser.add_argument("--output_format", "-f", type=str, default="all", choices=["all", "srt", "vtt", "txt", "tsv", "json", "aud"], help="format of the output file; if not specified, all available formats will be produced")
     parser.add_argument("--verbose", type=str2bool, default=True, help="whether to print out the progress and debug messages")
+    parser.add_argument("--audio_cache_dir", type=str, default=None, help="directory to cache decoded audio in, so repeated runs on the same files skip decoding; disabled by default")
+    parser.add_argument("--audio_cache_size", type=float, default=10.0, help="maximum size of the decoded audio cache in GB, least recently used files are evicted beyond it")
 
     parser.add_argument("--task", type=str, default="transcribe", choices=["transcribe", "translate"], help="whether to perform X->X speech recognition ('transcribe') or X->English translation ('translate')")
     parser.add_argument("--language", type=str, default=None, choices=sorted(LANGUAGES.keys()) + sorted([k.title() for k in TO_LANGUAGE_CODE.keys()]), help="language spoken in the audio, specify None to perform language detection")
@@ -48,6 +51,15 @@ def cli():
     parser.add_argument("--vad_onset", type=float, default=0.500, help="Onset threshold for VAD (see pyannote.audio), reduce this if speech is not being detected")
     parser.add_argument("--vad_offset", type=float, default=0.363, help="Offset threshold for VAD (see pyannote.audio), reduce this if speech is not being detected.")
     parser.add_argument("--chunk_size", type=int, default=30, help="Chunk size for merging VAD segments. Default is 30, reduce this if the chunk is too long.")
+    parser.add_argument("--chunk_packing", type=str, default="greedy", choices=["greedy", "pack"], help="how VAD segments are merged into chunks: 'greedy' closes a chunk when the next segment does not fit, 'pack' splits that segment at its quietest point to fill the chunk, needing fewer encoder windows")
+    parser.add_argument("--cascade_model", type=str, default=None, help="name of a larger Whisper model to re-decode the chunks the main model is not confident about, e.g. large-v2")
+    parser.add_argument("--cascade_logprob_threshold", type=float, default=-0.5, help="with --cascade_model, re-decode chunks whose average log probability is below this value")
+    parser.add_argument("--cascade_compression_ratio_threshold", type=float, default=2.0, help="with --cascade_model, re-decode chunks whose gzip compression ratio is above this value")
+    parser.add_argument("--lid_windows", type=int, default=1, help="number of speech chunks spread over the file to detect the language on, in one batched encoder call, when --language is not given")
+    parser.add_argument("--batch_schedule", type=str, default="time", choices=["time", "length"], help="order in which chunks are batched: 'time' keeps chronological order, 'length' batches chunks of similar duration together so batches finish decoding sooner; output order is unchanged")
+    parser.add_argument("--max_silence", type=optional_float, default=None, help="cut silences longer than this many seconds between the speech segments of a chunk, so more speech fits in each window; timestamps still refer to the original audio")
+    parser.add_argument("--vad_method", type=str, default="pyannote", choices=["pyannote", "energy"], help="VAD backend: 'pyannote' runs the pyannote segmentation model, 'energy' gates log-Mel energy and spectral flux, which is much faster on CPU and needs no model download")
+    parser.add_argument("--vad_cache_dir", type=str, default=None, help="directory to cache VAD scores in, so re-running the same audio with different --vad_onset, --vad_offset or --chunk_size skips the VAD model; disabled by default")
 
     # diarization params
     parser.add_argument("--diarize", action="store_true", help="Apply diarization to assign speaker labels to each segment/word")
@@ -88,7 +100,8 @@ def cli():
 
     args = parser.parse_args().__dict__
     model_name: str = args.pop("model")
-    batch_size: int = args.pop("batch_size")
+    batch_size = args.pop("batch_size")
+    latency_budget: float = args.pop("latency_budget")
     model_dir: str = args.pop("model_dir")
     output_dir: str = args.pop("output_dir")
     output_format: str = args.pop("output_format")
@@ -96,10 +109,14 @@ def cli():
     device_index: int = args.pop("device_index")
     compute_type: str = args.pop("compute_type")
     realtime: bool = args.pop("realtime")
+    audio_cache_dir: str = args.pop("audio_cache_dir")
+    audio_cache_size: float = args.pop("audio_cache_size")
     # TODO: add support for linux
     platform = 'osx'
     # model_flush: bool = args.pop("model_flush")
     os.makedirs(output_dir, exist_ok=True)
+    if audio_cache_dir is not None:
+        set_audio_cache(audio_cache_dir, max_size=int(audio_cache_size * 1024 ** 3))
 
 
     if realtime:
@@ -135,8 +152,17 @@ def cli():
     hf_token: str = args.pop("hf_token")
     vad_onset: float = args.pop("vad_onset")
     vad_offset: float = args.pop("vad_offset")
+    vad_cache_dir: str = args.pop("vad_cache_dir")
+    vad_method: str = args.pop("vad_method")
 
     chunk_size: int = args.pop("chunk_size")
+    chunk_packing: str = args.pop("chunk_packing")
+    max_silence = args.pop("max_silence")
+    batch_schedule: str = args.pop("batch_schedule")
+    lid_windows: int = args.pop("lid_windows")
+    cascade_model: str = args.pop("cascade_model")
+    cascade_logprob_threshold: float = args.pop("cascade_logprob_threshold")
+    cascade_compression_ratio_threshold: float = args.pop("cascade_compression_ratio_threshold")
 
     diarize: bool = args.pop("diarize")
     min_speakers: int = args.pop("min_speakers")
@@ -198,7 +224,7 @@ def cli():
     results = []
     tmp_results = []
     # model = load_model(model_name, device=device, download_root=model_dir)
-    model = load_model(model_name, device=device, device_index=device_index, download_root=model_dir, compute_type=compute_type, language=args['language'], asr_options=asr_options, vad_options={"vad_onset": vad_onset, "vad_offset": vad_offset}, task=task, threads=faster_whisper_threads)
+    model = load_model(model_name, device=device, device_index=device_index, download_root=model_dir, compute_type=compute_type, language=args['language'], asr_options=asr_options, vad_options={"vad_onset": vad_onset, "vad_offset": vad_offset, "vad_cache_dir": vad_cache_dir, "vad_method": vad_method}, task=task, threads=faster_whisper_threads, cascade_model=cascade_model)
 
     # The last time a recording was retrieved from the queue.
     phrase_time = None
@@ -272,7 +298,7 @@ def cli():
 
                 audio_np = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
                 print(">>Performing transcription...")
-                result = model.transcribe(audio_np, batch_size=batch_size, chunk_size=chunk_size, print_progress=print_progress)
+                result = model.transcribe(audio_np, batch_size=batch_size, chunk_size=chunk_size, print_progress=print_progress, chunk_packing=chunk_packing, max_silence=max_silence, batch_schedule=batch_schedule, latency_budget=latency_budget, lid_windows=lid_windows, cascade_logprob_threshold=cascade_logprob_threshold, cascade_compression_ratio_threshold=cascade_compression_ratio_threshold)
                 results.append((result, audio_snippet_file_path))
                 # print(f"@@@@ results.... @@@@")
                 print(results)
@@ -1,23 +1,37 @@
-import hashlib
+import functools
+import itertools
 import os
 import urllib
-from typing import Callable, Optional, Text, Union
+from typing import Callable, Optional, Union
 
 import numpy as np
 import pandas as pd
 import torch
-from pyannote.audio import Model
-from pyannote.audio.core.io import AudioFile
-from pyannote.audio.pipelines import VoiceActivityDetection
-from pyannote.audio.pipelines.utils import PipelineModel
-from pyannote.core import Annotation, Segment, SlidingWindowFeature
+from pyannote.core import Annotation, Segment, SlidingWindow, SlidingWindowFeature
 from tqdm import tqdm
 
-from .diarize import Segment as SegmentX
+from .audio import SAMPLE_RATE, log_mel_frames
+from .cache import DiskCache, array_sha256, verify_file
 
 VAD_SEGMENTATION_URL = "https://whisperx.s3.eu-west-2.amazonaws.com/model_weights/segmentation/0b5b3216d60a2d32fc086b47ea8c67589aaeb26b7e07fcbe620d6d0b83e209ea/pytorch_model.bin"
 
-def load_vad_model(device, vad_onset=0.500, vad_offset=0.363, use_auth_token=None, model_fp=None):
+def load_vad_model(device, vad_onset=0.500, vad_offset=0.363, use_auth_token=None, model_fp=None, vad_cache_dir=None, vad_method="pyannote"):
+    """
+    Load the VAD model used to find the speech regions to transcribe. `vad_method` is "pyannote"
+    for the pyannote segmentation model, or "energy" for `EnergyVAD`, which needs neither
+    pyannote.audio nor a checkpoint.
+    """
+    if vad_method == "energy":
+        vad_pipeline = EnergyVAD(device=device)
+        if vad_cache_dir is not None:
+            return CachedVAD(vad_pipeline, DiskCache(vad_cache_dir), EnergyVAD.VERSION)
+        return vad_pipeline
+    if vad_method != "pyannote":
+        raise ValueError(f"Unsupported VAD method: {vad_method}")
+
+    # pyannote.audio is only imported when its model is actually used
+    from .vad_pyannote import VoiceActivitySegmentation
+
     model_dir = torch.hub._get_torch_home()
     os.makedirs(model_dir, exist_ok = True)
     if model_fp is None:
@@ -42,13 +56,16 @@ def load_vad_model(device, vad_onset=0.500, vad_offset=0.363, use_auth_token=Non
                     output.write(buffer)
                     loop.update(len(buffer))
 
-    model_bytes = open(model_fp, "rb").read()
-    if hashlib.sha256(model_bytes).hexdigest() != VAD_SEGMENTATION_URL.split('/')[-2]:
+    checksum = VAD_SEGMENTATION_URL.split('/')[-2]
+    if not verify_file(model_fp, checksum):
         raise RuntimeError(
             "Model has been downloaded but the SHA256 checksum does not not match. Please retry loading the model."
         )
 
-    vad_model = Model.from_pretrained(model_fp, use_auth_token=use_auth_token)
+    stat = os.stat(model_fp)
+    vad_model = _load_segmentation_model(
+        model_fp, stat.st_mtime_ns, stat.st_size, use_auth_token, str(torch.device(device))
+    )
     hyperparameters = {"onset": vad_onset, 
                     "offset": vad_offset,
                     "min_duration_on": 0.1,
@@ -56,8 +73,36 @@ def load_vad_model(device, vad_onset=0.500, vad_offset=0.363, use_auth_token=Non
     vad_pipeline = VoiceActivitySegmentation(segmentation=vad_model, device=torch.device(device))
     vad_pipeline.instantiate(hyperparameters)
 
+    if vad_cache_dir is not None:
+        return CachedVAD(vad_pipeline, DiskCache(vad_cache_dir), checksum)
     return vad_pipeline
 
+
+@functools.lru_cache(maxsize=None)
+def _load_segmentation_model(model_fp, mtime_ns, size, use_auth_token, device):
+    # one model per checkpoint and device per process, shared by every pipeline built from it;
+    # mtime and size are part of the key so a replaced checkpoint is reloaded
+    from pyannote.audio import Model
+
+    return Model.from_pretrained(model_fp, use_auth_token=use_auth_token).to(torch.device(device))
+
+
+def __getattr__(name):
+    # kept importable from here now that it lives in vad_pyannote
+    if name == "VoiceActivitySegmentation":
+        from .vad_pyannote import VoiceActivitySegmentation
+
+        return VoiceActivitySegmentation
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def frame_middles(sliding_window: SlidingWindow, num_frames: int) -> np.ndarray:
+    """Middle time of the first `num_frames` frames of `sliding_window`, with the same floating
+    point operations as `sliding_window[i].middle` but without building a Segment per frame."""
+    starts = sliding_window.start + np.arange(num_frames) * sliding_window.step
+    return 0.5 * (starts + (starts + sliding_window.duration))
+
+
 class Binarize:
     """Binarize detection scores using hysteresis thresholding, with min-cut operation
     to ensure not segments are longer than max_duration.
@@ -128,55 +173,15 @@ class Binarize:
         """
 
         num_frames, num_classes = scores.data.shape
-        frames = scores.sliding_window
-        timestamps = [frames[i].middle for i in range(num_frames)]
+        timestamps = frame_middles(scores.sliding_window, num_frames)
 
         # annotation meant to store 'active' regions
         active = Annotation()
         for k, k_scores in enumerate(scores.data.T):
 
             label = k if scores.labels is None else scores.labels[k]
-
-            # initial state
-            start = timestamps[0]
-            is_active = k_scores[0] > self.onset
-            curr_scores = [k_scores[0]]
-            curr_timestamps = [start]
-            t = start
-            for t, y in zip(timestamps[1:], k_scores[1:]):
-                # currently active
-                if is_active: 
-                    curr_duration = t - start
-                    if curr_duration > self.max_duration:
-                        search_after = len(curr_scores) // 2
-                        # divide segment
-                        min_score_div_idx = search_after + np.argmin(curr_scores[search_after:])
-                        min_score_t = curr_timestamps[min_score_div_idx]
-                        region = Segment(start - self.pad_onset, min_score_t + self.pad_offset)
-                        active[region, k] = label
-                        start = curr_timestamps[min_score_div_idx]
-                        curr_scores = curr_scores[min_score_div_idx+1:]
-                        curr_timestamps = curr_timestamps[min_score_div_idx+1:]
-                    # switching from active to inactive
-                    elif y < self.offset:
-                        region = Segment(start - self.pad_onset, t + self.pad_offset)
-                        active[region, k] = label
-                        start = t
-                        is_active = False
-                        curr_scores = []
-                        curr_timestamps = []
-                    curr_scores.append(y)
-                    curr_timestamps.append(t)
-                # currently inactive
-                else:
-                    # switching from inactive to active
-                    if y > self.onset:
-                        start = t
-                        is_active = True
-
-            # if active at the end, add final region
-            if is_active:
-                region = Segment(start - self.pad_onset, t + self.pad_offset)
+            for start, end in self._active_regions(k_scores, timestamps):
+                region = Segment(start - self.pad_onset, end + self.pad_offset)
                 active[region, k] = label
 
         # because of padding, some active regions might be overlapping: merge them.
@@ -194,50 +199,229 @@ class Binarize:
 
         return active
 
+    def _active_regions(self, k_scores: np.ndarray, timestamps: np.ndarray):
+        """Hysteresis thresholding with min-cut of a single class, as a list of (start, end) times.
+
+        Onset/offset transitions are located with array operations, so the Python loop runs once
+        per region or min-cut rather than once per frame.
+        """
+        num_frames = len(k_scores)
+        if num_frames == 0:
+            return []
+        onsets = np.flatnonzero(k_scores > self.onset)
+        offsets = np.flatnonzero(k_scores < self.offset)
+
+        def next_index(indices, i):
+            # first of `indices` at or after frame i
+            pos = np.searchsorted(indices, i)
+            return indices[pos] if pos < len(indices) else num_frames
+
+        def next_cut(i, start):
+            # first frame at or after i where `t - start > max_duration`
+            if self.max_duration == float("inf"):
+                return num_frames
+            j = i + int(np.searchsorted(timestamps[i:], start + self.max_duration))
+            while j > i and timestamps[j - 1] - start > self.max_duration:
+                j -= 1
+            while j < num_frames and not timestamps[j] - start > self.max_duration:
+                j += 1
+            return j
+
+        # The scores searched by the min-cut are frames [lo, i), preceded by frame `prefix` unless it
+        # is None: the frame which ended the previous region (initially frame 0) stays at the head of
+        # the buffer until the next cut, and frames are only added to it while active.
+        regions = []
+        prefix, lo = 0, 1
+        start = float(timestamps[0])
+        is_active = k_scores[0] > self.onset
+        i = 1
+        while i < num_frames:
+            if not is_active:
+                # switching from inactive to active
+                j = next_index(onsets, i)
+                if j == num_frames:
+                    break
+                start = float(timestamps[j])
+                is_active = True
+                lo = i = j + 1
+                continue
+
+            cut = next_cut(i, start)
+            off = next_index(offsets, i)
+            if cut == num_frames and off == num_frames:
+                break
+            if cut <= off:
+                # divide segment at the lowest score in the second half of the buffer
+                buffer = k_scores[lo:cut]
+                if prefix is not None:
+                    buffer = np.concatenate([k_scores[prefix : prefix + 1], buffer])
+                search_after = len(buffer) // 2
+                min_score_div_idx = search_after + np.argmin(buffer[search_after:])
+                if prefix is None:
+                    div_frame = lo + min_score_div_idx
+                elif min_score_div_idx > 0:
+                    div_frame = lo + min_score_div_idx - 1
+                else:
+                    div_frame = prefix
+                min_score_t = float(timestamps[div_frame])
+                regions.append((start, min_score_t))
+                start = min_score_t
+                if div_frame != prefix:
+                    lo = div_frame + 1
+                prefix = None
+                # the cut frame itself joins the buffer without being checked against offset
+                i = cut + 1
+            else:
+                # switching from active to inactive
+                end = float(timestamps[off])
+                regions.append((start, end))
+                start = end
+                is_active = False
+                prefix, lo = off, off + 1
+                i = off + 1
+
+        # if active at the end, add final region
+        if is_active:
+            regions.append((start, float(timestamps[-1])))
+        return regions
+
+
+class EnergyVAD:
+    """
+    A lightweight VAD backend scoring each 10 ms log-Mel frame by its energy and spectral flux,
+    with no model to download. Speech is both louder than the background and constantly changing,
+    so a frame's score is the geometric mean of its energy and its smoothed spectral flux, each
+    scaled to [0, 1] between low and high percentiles over the input. The scores can be used in
+    place of the pyannote model's, e.g. with `merge_chunks`.
+
+    Parameters
+    ----------
+    n_mels: int
+        The number of Mel-frequency filters of the frames
+
+    low_percentile, high_percentile: float
+        The percentiles of the input mapped to scores 0 and 1
+
+    noise_floor: float
+        The log10 Mel power below which a frame is always silent, so digital silence is never
+        scaled up to speech
+
+    min_range: float
+        The minimum difference in log10 Mel power between scores 0 and 1, so inputs with little
+        dynamic range are not scaled up to the full range
+
+    smoothing: float
+        The duration in seconds of the moving average applied to the energy
+
+    flux_smoothing: float
+        The duration in seconds of the moving average applied to the spectral flux, long enough to
+        cover steady vowels
+
+    device: Optional[Union[str, torch.device]]
+        The device the log-Mel frames are computed on
+    """
+
+    # identifies the scoring in cached scores, bump it when changing the defaults or the scoring
+    VERSION = "energy-v1"
 
-class VoiceActivitySegmentation(VoiceActivityDetection):
     def __init__(
         self,
-        segmentation: PipelineModel = "pyannote/segmentation",
-        fscore: bool = False,
-        use_auth_token: Union[Text, None] = None,
-        **inference_kwargs,
+        n_mels: int = 80,
+        low_percentile: float = 10.0,
+        high_percentile: float = 90.0,
+        noise_floor: float = -8.0,
+        min_range: float = 1.5,
+        smoothing: float = 0.1,
+        flux_smoothing: float = 0.5,
+        device: Optional[Union[str, torch.device]] = None,
     ):
+        self.n_mels = n_mels
+        self.low_percentile = low_percentile
+        self.high_percentile = high_percentile
+        self.noise_floor = noise_floor
+        self.min_range = min_range
+        self.smoothing = smoothing
+        self.flux_smoothing = flux_smoothing
+        self.device = device
+
+    @staticmethod
+    def _smooth(x: np.ndarray, num_frames: int) -> np.ndarray:
+        # a window longer than `x` would make the "same" convolution longer than `x`
+        num_frames = min(num_frames, len(x))
+        if num_frames <= 1:
+            return x
+        return np.convolve(x, np.full(num_frames, 1.0 / num_frames, dtype=x.dtype), mode="same")
+
+    def __call__(self, file: dict) -> SlidingWindowFeature:
+        waveform = file["waveform"]
+        assert file["sample_rate"] == SAMPLE_RATE, f"EnergyVAD expects {SAMPLE_RATE} Hz audio"
+        log_spec = log_mel_frames(waveform.reshape(-1), n_mels=self.n_mels, device=self.device).numpy()
+        # frame k is centred on k * step
+        step = 0.01
+        frames = SlidingWindow(start=-0.0125, duration=0.025, step=step)
+        if log_spec.shape[1] == 0:
+            return SlidingWindowFeature(np.zeros((0, 1), dtype=np.float32), frames)
+
+        energy = self._smooth(log_spec.mean(axis=0), round(self.smoothing / step))
+        low, high = np.percentile(energy, [self.low_percentile, self.high_percentile])
+        low = max(low, self.noise_floor)
+        high = max(high, low + self.min_range)
+        energy_score = np.clip((energy - low) / (high - low), 0.0, 1.0)
+
+        flux = np.zeros_like(energy)
+        flux[1:] = np.maximum(np.diff(log_spec, axis=1), 0.0).mean(axis=0)
+        flux = self._smooth(flux, round(self.flux_smoothing / step))
+        flux_high = np.percentile(flux, self.high_percentile)
+        flux_score = np.clip(flux / flux_high, 0.0, 1.0) if flux_high > 0 else np.zeros_like(flux)
+
+        scores = np.sqrt(energy_score * flux_score)
+        return SlidingWindowFeature(scores[:, None].astype(np.float32), frames)
+
+
+class CachedVAD:
+    """
+    Wraps a VAD model to persist its frame scores on disk, keyed by the content of the waveform and
+    the checksum of the model. Binarization and merging (onset, offset, chunk_size) are applied
+    afterwards in `merge_chunks`, so sweeping those parameters only runs the model once per file.
 
-        super().__init__(segmentation=segmentation, fscore=fscore, use_auth_token=use_auth_token, **inference_kwargs)
+    Parameters
+    ----------
+    vad_model: Callable
+        The VAD model, called with {"waveform": Tensor, "sample_rate": int} and returning the
+        frame scores as a SlidingWindowFeature
 
-    def apply(self, file: AudioFile, hook: Optional[Callable] = None) -> Annotation:
-        """Apply voice activity detection
+    cache: DiskCache
+        Where to store the scores
 
-        Parameters
-        ----------
-        file : AudioFile
-            Processed file.
-        hook : callable, optional
-            Hook called after each major step of the pipeline with the following
-            signature: hook("step_name", step_artefact, file=file)
-
-        Returns
-        -------
-        speech : Annotation
-            Speech regions.
-        """
+    checksum: str
+        Identifies the model weights, so a different model never reuses cached scores
+    """
 
-        # setup hook (e.g. for debugging purposes)
-        hook = self.setup_hook(file, hook=hook)
+    def __init__(self, vad_model, cache: DiskCache, checksum: str):
+        self.vad_model = vad_model
+        self.cache = cache
+        self.checksum = checksum
+
+    def __call__(self, file: dict) -> SlidingWindowFeature:
+        waveform = file["waveform"].contiguous()
+        key = f"{array_sha256(waveform)}-{file['sample_rate']}-{self.checksum}.npz"
+        path = self.cache.get(key)
+        if path is not None:
+            with np.load(path) as cached:
+                frames = SlidingWindow(
+                    start=float(cached["start"]), duration=float(cached["duration"]), step=float(cached["step"])
+                )
+                return SlidingWindowFeature(cached["data"], frames)
+
+        scores = self.vad_model(file)
+        frames = scores.sliding_window
 
-        # apply segmentation model (only if needed)
-        # output shape is (num_chunks, num_frames, 1)
-        if self.training:
-            if self.CACHED_SEGMENTATION in file:
-                segmentations = file[self.CACHED_SEGMENTATION]
-            else:
-                segmentations = self._segmentation(file)
-                file[self.CACHED_SEGMENTATION] = segmentations
-        else:
-            segmentations: SlidingWindowFeature = self._segmentation(file)
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                np.savez(f, data=scores.data, start=frames.start, duration=frames.duration, step=frames.step)
 
-        return segmentations
+        self.cache.put(key, write)
+        return scores
 
 
 def merge_vad(vad_arr, pad_onset=0.0, pad_offset=0.0, min_duration_off=0.0, min_duration_on=0.0):
@@ -261,51 +445,307 @@ def merge_vad(vad_arr, pad_onset=0.0, pad_offset=0.0, min_duration_off=0.0, min_
     active_segs = pd.DataFrame([x['segment'] for x in active['content']])
     return active_segs
 
+class ChunkMerger:
+    """
+    Merge consecutive speech turns into chunks of at most `chunk_size` seconds, one turn at a time,
+    so chunks can be handed out as soon as they are complete.
+
+    With the default "greedy" packing a chunk is closed as soon as the next turn does not fit in
+    it, as described in the paper. With "pack", the turn that does not fit is first split at its
+    lowest VAD score within the time left in the chunk, so every chunk is filled close to
+    `chunk_size` and fewer encoder windows are needed. Both keep chronological order.
+
+    If `max_silence` is set, silences between turns longer than that are cut down to `max_silence`
+    seconds when the chunk audio is built, and only the compacted duration counts towards
+    `chunk_size`. Such chunks carry a "pieces" list of the (start, end) spans of original audio
+    they are made of; their "start" and "end" stay in original-file time.
+
+    Parameters
+    ----------
+    chunk_size: float
+        The maximum duration of a chunk in seconds
+
+    packing: str
+        "greedy" or "pack"
+
+    min_split: float
+        With "pack", the minimum duration in seconds of both parts of a split turn
+
+    max_silence: Optional[float]
+        The longest silence in seconds kept between two turns of a chunk, None to keep them all
+    """
+
+    def __init__(self, chunk_size, packing: str = "greedy", min_split: float = 1.0, max_silence: Optional[float] = None):
+        assert chunk_size > 0
+        if packing not in ("greedy", "pack"):
+            raise ValueError(f"Unsupported chunk packing: {packing}")
+        self.chunk_size = chunk_size
+        self.packing = packing
+        self.min_split = min_split
+        self.max_silence = max_silence
+        self.curr_start = None
+        self.curr_end = 0
+        self.curr_duration = 0
+        self.seg_idxs = []
+
+    def _silence(self, start):
+        # duration the gap before a turn starting at `start` takes in the chunk
+        gap = start - self.curr_end
+        return gap if self.max_silence is None else min(gap, self.max_silence)
+
+    def add(self, start, end, split: Optional[Callable] = None):
+        """
+        Add the next speech turn, returning the previous chunk if the turn does not fit in it.
+        `split(lo, hi)` returns the time of the lowest VAD score within [lo, hi], or None if there
+        is no frame in it; it is only needed with "pack".
+        """
+        merged = None
+        if self.curr_start is None:
+            # Make sur the starting point is the start of the segment.
+            self.curr_start = start
+            self.curr_end = start
+        else:
+            # latest end time of the turn for it to fit in the current chunk
+            room_end = start + self.chunk_size - self.curr_duration - self._silence(start)
+            if end > room_end and self.curr_end - self.curr_start > 0:
+                if self.packing == "pack" and split is not None:
+                    # look ahead into the turn instead of closing the chunk early
+                    cut = split(start + self.min_split, min(room_end, end - self.min_split))
+                    if cut is not None:
+                        self._append(start, cut)
+                        start = cut
+                merged = self.flush()
+                self.curr_start = start
+                self.curr_end = start
+        self._append(start, end)
+        return merged
+
+    def _append(self, start, end):
+        self.curr_duration += self._silence(start) + end - start
+        self.curr_end = end
+        self.seg_idxs.append((start, end))
+
+    def flush(self):
+        """Return the current chunk, if any, and start a new one."""
+        if self.curr_start is None:
+            return None
+        merged = {
+            "start": self.curr_start,
+            "end": self.curr_end,
+            "segments": self.seg_idxs,
+        }
+        if self.max_silence is not None:
+            merged["pieces"] = compact_pieces(self.seg_idxs, self.max_silence)
+        self.curr_start = None
+        self.curr_duration = 0
+        self.seg_idxs = []
+        return merged
+
+
+def compact_pieces(seg_idxs, max_silence):
+    """
+    The spans of original audio that make up a chunk of speech turns `seg_idxs` once silences
+    longer than `max_silence` seconds are cut down: half of `max_silence` is kept after the end of
+    a turn and half before the start of the next one.
+    """
+    pieces = [list(seg_idxs[0])]
+    for start, end in seg_idxs[1:]:
+        if start - pieces[-1][1] > max_silence:
+            pieces[-1][1] += max_silence / 2
+            pieces.append([start - max_silence / 2, end])
+        else:
+            pieces[-1][1] = end
+    return [tuple(piece) for piece in pieces]
+
+
+def lowest_score_split(scores: SlidingWindowFeature) -> Callable:
+    """
+    Return a `split(lo, hi)` function for `ChunkMerger`, giving the middle time of the frame of
+    `scores` with the lowest speech score between lo and hi seconds.
+    """
+    speech = scores.data.max(axis=1)
+    timestamps = frame_middles(scores.sliding_window, len(speech))
+
+    def split(lo, hi):
+        first, last = np.searchsorted(timestamps, [lo, hi], side="right")
+        if first >= last:
+            return None
+        return float(timestamps[first + np.argmin(speech[first:last])])
+
+    return split
+
+
+def chunk_duration(chunk) -> float:
+    """Duration in seconds of the audio of a merged chunk, after silence compaction if any."""
+    if "pieces" in chunk:
+        return sum(end - start for start, end in chunk["pieces"])
+    return chunk["end"] - chunk["start"]
+
+
+def length_bucketed(chunks, window: Optional[int] = None):
+    """
+    Reorder merged chunks so that chunks of similar duration, and so of similar expected token
+    count, are batched together and no batch keeps decoding long after most of its sequences have
+    ended. Yields (index, chunk) with `index` the position of the chunk in `chunks`, so the
+    chronological order can be restored afterwards.
+
+    Chunks are sorted by decreasing duration within consecutive groups of `window` chunks, or all
+    at once if `window` is None; a window bounds how far ahead a stream of chunks is read.
+    """
+    chunks = enumerate(chunks)
+    while True:
+        group = list(itertools.islice(chunks, window))
+        if not group:
+            return
+        yield from sorted(group, key=lambda item: -chunk_duration(item[1]))
+        if window is None:
+            return
+
+
+def packing_stats(merged_segments, chunk_size, audio_duration: Optional[float] = None) -> dict:
+    """
+    Summarise how well merged chunks fill the fixed-size encoder windows: the number of windows,
+    the fraction of window time covered by speech turns and, given the duration of the audio in
+    seconds, the number of windows per hour of audio.
+    """
+    speech = sum(end - start for chunk in merged_segments for start, end in chunk["segments"])
+    windows = len(merged_segments)
+    stats = {
+        "windows": windows,
+        "speech_duration": speech,
+        "fill_ratio": speech / (windows * chunk_size) if windows > 0 else 0.0,
+    }
+    if audio_duration:
+        stats["windows_per_hour"] = windows * 3600 / audio_duration
+    if any("pieces" in chunk for chunk in merged_segments):
+        stats["silence_removed"] = sum(
+            chunk["end"] - chunk["start"] - sum(end - start for start, end in chunk["pieces"])
+            for chunk in merged_segments
+            if "pieces" in chunk
+        )
+    return stats
+
+
 def merge_chunks(
     segments,
     chunk_size,
     onset: float = 0.5,
     offset: Optional[float] = None,
+    packing: str = "greedy",
+    max_silence: Optional[float] = None,
 ):
     """
-    Merge operation described in paper
+    Merge operation described in paper, see `ChunkMerger` for `packing` and `max_silence`
     """
-    curr_end = 0
-    merged_segments = []
-    seg_idxs = []
-    speaker_idxs = []
-
-    assert chunk_size > 0
     binarize = Binarize(max_duration=chunk_size, onset=onset, offset=offset)
+    split = lowest_score_split(segments)
     segments = binarize(segments)
-    segments_list = []
-    for speech_turn in segments.get_timeline():
-        segments_list.append(SegmentX(speech_turn.start, speech_turn.end, "UNKNOWN"))
 
-    if len(segments_list) == 0:
+    merger = ChunkMerger(chunk_size, packing=packing, max_silence=max_silence)
+    merged_segments = []
+    for speech_turn in segments.get_timeline():
+        merged = merger.add(speech_turn.start, speech_turn.end, split=split)
+        if merged is not None:
+            merged_segments.append(merged)
+    # add final
+    merged = merger.flush()
+    if merged is None:
         print("No active speech found in audio")
         return []
-    # assert segments_list, "segments_list is empty."
-    # Make sur the starting point is the start of the segment.
-    curr_start = segments_list[0].start
-
-    for seg in segments_list:
-        if seg.end - curr_start > chunk_size and curr_end-curr_start > 0:
-            merged_segments.append({
-                "start": curr_start,
-                "end": curr_end,
-                "segments": seg_idxs,
-            })
-            curr_start = seg.start
-            seg_idxs = []
-            speaker_idxs = []
-        curr_end = seg.end
-        seg_idxs.append((seg.start, seg.end))
-        speaker_idxs.append(seg.speaker)
-    # add final
-    merged_segments.append({ 
-                "start": curr_start,
-                "end": curr_end,
-                "segments": seg_idxs,
-            })    
+    merged_segments.append(merged)
     return merged_segments
+
+
+def merge_chunks_streaming(
+    vad_model,
+    audio: np.ndarray,
+    chunk_size,
+    onset: float = 0.5,
+    offset: Optional[float] = None,
+    block_duration: float = 600.0,
+    overlap_duration: float = 30.0,
+    sample_rate: int = SAMPLE_RATE,
+    packing: str = "greedy",
+    max_silence: Optional[float] = None,
+):
+    """
+    Streaming version of running `vad_model` on the whole `audio` followed by `merge_chunks`.
+
+    The segmentation model runs on overlapping blocks of `block_duration` seconds, whose frame
+    scores are stitched by keeping the middle of each overlap. Stitched scores are binarized up to
+    the last point where speech is surely inactive (two consecutive frames below the offset
+    threshold), after which the state of the hysteresis is the same as at the start of a file.
+    Blocks start on a frame of the first block, so for a model whose frame scores only depend on
+    the audio around each frame the produced chunks are those of `merge_chunks`. Otherwise they
+    are an approximation: the segmentation model sees less context near the block edges, and if
+    its frame step is not a whole number of samples, later blocks are offset by a fraction of a
+    frame. Chunks are yielded as soon as they can no longer change, and memory is bounded by the
+    block size rather than the file length, except for stretches of speech with no pause at all.
+    """
+    offset = offset or onset
+    binarize = Binarize(max_duration=chunk_size, onset=onset, offset=offset)
+    merger = ChunkMerger(chunk_size, packing=packing, max_silence=max_silence)
+
+    num_samples = audio.shape[0]
+    block_size = int(block_duration * sample_rate)
+    overlap = int(overlap_duration * sample_rate)
+    assert block_size > overlap, "block_duration must be longer than overlap_duration"
+
+    frames = None  # sliding window of the whole file, taken from the first block
+    pending = []  # stitched frame scores not binarized yet
+    pending_start = 0  # index of the first pending frame in the whole file
+    next_frame = 0  # index of the next frame to stitch
+    block_start = 0
+    while block_start < num_samples:
+        block_end = min(block_start + block_size, num_samples)
+        waveform = torch.from_numpy(np.ascontiguousarray(audio[block_start:block_end]))
+        scores = vad_model({"waveform": waveform.unsqueeze(0), "sample_rate": sample_rate})
+        if frames is None:
+            frames = scores.sliding_window
+        is_last = block_end == num_samples
+        # the next block starts on a frame, so that its frames are those of the whole file
+        next_start = int(round(int((block_end - overlap) / sample_rate / frames.step) * frames.step * sample_rate))
+
+        # keep the frames between the middles of the overlaps with the previous and next blocks
+        first_frame = int(round(block_start / sample_rate / frames.step))
+        keep_until = first_frame + len(scores.data)
+        if not is_last:
+            keep_until = min(keep_until, int(round((block_end - overlap / 2) / sample_rate / frames.step)))
+        if keep_until > next_frame:
+            pending.append(scores.data[next_frame - first_frame : keep_until - first_frame])
+            next_frame = keep_until
+        if len(pending) == 0:
+            if is_last:
+                break
+            block_start = next_start
+            continue
+
+        data = np.concatenate(pending) if len(pending) > 1 else pending[0]
+        if is_last:
+            restart = len(data)
+        else:
+            quiet = (data < offset).all(axis=1)
+            quiet_pairs = np.flatnonzero(quiet[1:] & quiet[:-1])
+            restart = quiet_pairs[-1] + 2 if len(quiet_pairs) > 0 else 0
+
+        if restart > 0:
+            window = SlidingWindow(
+                start=frames.start + pending_start * frames.step, duration=frames.duration, step=frames.step
+            )
+            part = SlidingWindowFeature(data[:restart], window)
+            split = lowest_score_split(part)
+            for speech_turn in binarize(part).get_timeline():
+                merged = merger.add(speech_turn.start, speech_turn.end, split=split)
+                if merged is not None:
+                    yield merged
+            pending_start += restart
+            data = data[restart:]
+        pending = [data] if len(data) > 0 else []
+
+        if is_last:
+            break
+        block_start = next_start
+
+    merged = merger.flush()
+    if merged is not None:
+        yield merged